@@ -1,29 +1,328 @@
 import asyncio
+import collections
+import random
+import re
+import time
 import typing as tp
+from urllib.parse import urlsplit, parse_qs
 from aiohttp import (
     ClientResponseError,
     ClientPayloadError,
     ClientConnectorError,
 )
-from json import JSONDecodeError
-import aiohttp
-from config import form_error_json
+from json import JSONDecodeError, loads as json_loads
+from network_settings import SessionManager, session_manager
+from response_cache import ResponseCache
+from config import (
+    form_error_json, API, VKErrorCode, RateLimitSettings, TokenPoolSettings, ExecuteAPI, DefaultRequestSettings
+)
+from metrics import UPSTREAM_SECONDS, STAGE_SECONDS, VK_ERRORS, VK_RETRIES, TOKEN_FAILOVERS, REQUESTS_IN_FLIGHT
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def decode_json(body: bytes):
+    """The fastest JSON decoder available: orjson if it is installed, the standard library otherwise."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json_loads(body)
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens are added per second, up to `capacity`."""
+
+    def __init__(self, *, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self._updated_at is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                self._refill(loop.time())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+ACCESS_TOKEN_PATTERN = re.compile(r"(?<=[?&]access_token=)[^&]*")
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+class TokenState:
+    """Rate budget and health of one access token of a TokenPool."""
+
+    def __init__(self, token: str, *, rate: float, capacity: int, daily_limit: tp.Optional[int] = None):
+        self.token = token
+        self.bucket = TokenBucket(rate=rate, capacity=capacity)
+        self.daily_limit = daily_limit
+        self.in_flight = 0
+        self.requests = 0
+        self.day_started_at: tp.Optional[float] = None
+        self.day_requests = 0
+        self.unavailable_until = 0.0
+        self.last_error_code: tp.Optional[int] = None
+
+    def _roll_day(self, now: float):
+        if self.day_started_at is None or now - self.day_started_at >= SECONDS_PER_DAY:
+            self.day_started_at = now
+            self.day_requests = 0
+
+    def available_at(self, now: float) -> float:
+        """The earliest time the token can be used: now, the end of its cooldown or the end of its day."""
+        self._roll_day(now)
+        if self.daily_limit is not None and self.day_requests >= self.daily_limit:
+            return max(self.unavailable_until, self.day_started_at + SECONDS_PER_DAY)
+        return self.unavailable_until
+
+    @property
+    def is_auth_failed(self) -> bool:
+        return self.last_error_code == VKErrorCode.AUTHORIZATION_FAILED
+
+    def snapshot(self, now: float) -> dict:
+        return {"in_flight": self.in_flight, "requests": self.requests, "day_requests": self.day_requests,
+                "available_in": round(max(0.0, self.available_at(now) - now), 3),
+                "last_error_code": self.last_error_code}
+
+
+class TokenPool:
+    """Access tokens that requests are spread over, each with its own token bucket and daily budget.
+    A request goes to the available token with the fewest requests in flight (waiting for its bucket included);
+    a token that answers with "User authorization failed" (5) or "Flood control" (9) is put aside for a cooldown."""
+
+    failover_error_codes = (VKErrorCode.AUTHORIZATION_FAILED, VKErrorCode.FLOOD_CONTROL)
+
+    def __init__(self, tokens: tp.Iterable[str], *, requests_per_second: float = RateLimitSettings.REQUESTS_PER_SECOND,
+                 burst: int = RateLimitSettings.BURST, daily_limit: tp.Optional[int] = TokenPoolSettings.DAILY_LIMIT,
+                 flood_cooldown: float = TokenPoolSettings.FLOOD_COOLDOWN,
+                 auth_cooldown: float = TokenPoolSettings.AUTH_COOLDOWN):
+        self.tokens = list(dict.fromkeys(tokens))
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.daily_limit = daily_limit
+        self.cooldowns = {VKErrorCode.FLOOD_CONTROL: flood_cooldown, VKErrorCode.AUTHORIZATION_FAILED: auth_cooldown}
+        self.states: tp.List[TokenState] = []
+        self.reset()
+
+    def reset(self):
+        """New buckets and a clean health state for every token, e.g. for a new event loop."""
+        self.states = [TokenState(token, rate=self.requests_per_second, capacity=self.burst,
+                                  daily_limit=self.daily_limit) for token in self.tokens]
+
+    def __len__(self):
+        return len(self.states)
+
+    @staticmethod
+    def with_token(url: str, token: str) -> str:
+        if ACCESS_TOKEN_PATTERN.search(url):
+            return ACCESS_TOKEN_PATTERN.sub(token, url, count=1)
+        return f"{url}{'&' if '?' in url else '?'}access_token={token}"
+
+    def acquire(self, now: float) -> tp.Optional[TokenState]:
+        """The least loaded available token, counted as in flight until `release`; None if every token is resting.
+        The request itself is counted by `record_sent`, once it leaves with the token."""
+        available = [state for state in self.states if state.available_at(now) <= now]
+        if not available:
+            return None
+        state = min(available, key=lambda state: (state.in_flight, state.day_requests))
+        state.in_flight += 1
+        return state
+
+    @staticmethod
+    def record_sent(state: TokenState):
+        state.requests += 1
+        state.day_requests += 1
+
+    @staticmethod
+    def release(state: TokenState):
+        state.in_flight -= 1
+
+    def report(self, state: TokenState, error_code: tp.Optional[int], now: float):
+        """Records the outcome of a request made with the token."""
+        if error_code in self.cooldowns:
+            state.unavailable_until = max(state.unavailable_until, now + self.cooldowns[error_code])
+            state.last_error_code = error_code
+        elif error_code is None:
+            state.last_error_code = None
+
+    def next_available_at(self, now: float) -> tp.Optional[float]:
+        """When the next token becomes available; None if the only ones left failed authorization."""
+        waiting = [state.available_at(now) for state in self.states if not state.is_auth_failed]
+        return min(waiting) if waiting else None
+
+    def has_available(self, now: float) -> bool:
+        return any(state.available_at(now) <= now for state in self.states)
+
+    def snapshot(self, now: float) -> tp.List[dict]:
+        return [state.snapshot(now) for state in self.states]
+
+
+class RequestScheduler:
+    """Throttles requests to VK API: one token bucket per access token,
+    a global cap on requests in flight and retries with exponential backoff
+    when VK answers with "Too many requests per second" or "Flood control".
+
+    With a `token_pool` the access token of every request is replaced with the least loaded token of the pool,
+    and a request that failed with error 5 or 9 is sent again right away with another token."""
+
+    retry_error_codes = (VKErrorCode.TOO_MANY_REQUESTS, VKErrorCode.FLOOD_CONTROL)
+
+    def __init__(self, *, requests_per_second: float = RateLimitSettings.REQUESTS_PER_SECOND,
+                 burst: int = RateLimitSettings.BURST,
+                 max_concurrency: int = RateLimitSettings.MAX_CONCURRENCY,
+                 max_retries: int = RateLimitSettings.MAX_RETRIES,
+                 backoff_base: float = RateLimitSettings.BACKOFF_BASE,
+                 backoff_max: float = RateLimitSettings.BACKOFF_MAX,
+                 token_pool: tp.Optional[TokenPool] = None):
+        """`max_concurrency` is per token when there is a pool."""
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_pool = token_pool
+        self._loop = None
+        self._semaphore = None
+        self._buckets: tp.Dict[tp.Optional[str], TokenBucket] = {}
+
+    @classmethod
+    def from_settings(cls, **options) -> "RequestScheduler":
+        """Scheduler over the tokens of API.ACCESS_TOKENS; the tokens of the URLs are used as they are without any."""
+        tokens = API.ACCESS_TOKENS
+        if not tokens or "token_pool" in options:
+            return cls(**options)
+        pool = TokenPool(tokens, **{name: options[name] for name in ("requests_per_second", "burst")
+                                    if name in options})
+        return cls(token_pool=pool, **options)
+
+    def _bind_loop(self):
+        # asyncio primitives are bound to the loop they were first used in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency * max(1, len(self.token_pool or ())))
+            self._buckets.clear()
+            if self.token_pool is not None:
+                self.token_pool.reset()
+
+    @staticmethod
+    def get_access_token(url: str) -> tp.Optional[str]:
+        return parse_qs(urlsplit(url).query).get("access_token", [None])[0]
+
+    @staticmethod
+    def get_vk_error_code(json) -> tp.Optional[int]:
+        if not isinstance(json, dict) or not isinstance(json.get("error"), dict):
+            return None
+        return json["error"].get("error_code")
+
+    def bucket_for(self, access_token: tp.Optional[str]) -> TokenBucket:
+        if access_token not in self._buckets:
+            self._buckets[access_token] = TokenBucket(rate=self.requests_per_second, capacity=self.burst)
+        return self._buckets[access_token]
+
+    def backoff_delay(self, attempt: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay + random.uniform(0, self.backoff_base)
+
+    async def acquire_token(self) -> tp.Optional[TokenState]:
+        """Waits for a token of the pool; None if every token failed authorization."""
+        while True:
+            now = self._loop.time()
+            state = self.token_pool.acquire(now)
+            if state is not None:
+                return state
+            available_at = self.token_pool.next_available_at(now)
+            if available_at is None:
+                return None
+            await asyncio.sleep(available_at - now)
+
+    async def schedule(self, fetch: tp.Callable[..., tp.Awaitable], url: str, *args, **kwargs):
+        self._bind_loop()
+        use_pool = bool(self.token_pool)
+        bucket = None if use_pool else self.bucket_for(self.get_access_token(url))
+        request_url, state, result = url, None, None
+        attempt = 0
+        while True:
+            if use_pool:
+                state = await self.acquire_token()
+                if state is None:
+                    return result if result is not None else form_error_json(
+                        error_code=VKErrorCode.AUTHORIZATION_FAILED, error_message="No access token available",
+                        details=f"Every access token of the pool failed authorization, url: {url}")
+                request_url, bucket = self.token_pool.with_token(url, state.token), state.bucket
+            try:
+                async with self._semaphore:
+                    await bucket.acquire()
+                    if state is not None and state.unavailable_until > self._loop.time():
+                        # the token was put aside while the request waited for its budget
+                        continue
+                    if state is not None:
+                        self.token_pool.record_sent(state)
+                    result = await fetch(request_url, *args, **kwargs)
+            finally:
+                if state is not None:
+                    self.token_pool.release(state)
+            error_code = self.get_vk_error_code(result)
+            if error_code is not None:
+                VK_ERRORS.inc(code=error_code)
+            if state is not None:
+                now = self._loop.time()
+                self.token_pool.report(state, error_code, now)
+                if (error_code in self.token_pool.failover_error_codes and attempt < self.max_retries
+                        and self.token_pool.has_available(now)):
+                    TOKEN_FAILOVERS.inc(code=error_code)
+                    attempt += 1
+                    continue
+            if error_code not in self.retry_error_codes or attempt >= self.max_retries:
+                return result
+            VK_RETRIES.inc(code=error_code)
+            await asyncio.sleep(self.backoff_delay(attempt))
+            attempt += 1
 
 
 class AsyncRequest:
-    def __init__(self, coroutine):
+    default_scheduler = RequestScheduler.from_settings()
+
+    def __init__(self, coroutine, *, scheduler: RequestScheduler = None, sessions: SessionManager = None,
+                 cache: ResponseCache = None, decoder: tp.Optional[tp.Callable[[bytes], tp.Any]] = None):
+        """With a `decoder` (e.g. decode_json) the body is read as raw bytes and decoded by it
+        instead of going through ClientResponse.json()."""
         self.coroutine = coroutine
+        self.scheduler = scheduler or self.default_scheduler
+        self.sessions = sessions or session_manager
+        self.cache = cache
+        self.decoder = decoder
 
     @staticmethod
-    async def fetch_content(url, session):
+    async def fetch_content(url, session, *, decoder: tp.Optional[tp.Callable[[bytes], tp.Any]] = None):
+        method = urlsplit(url).path.rsplit("/", 1)[-1]
         try:
-            async with session.get(url) as client:
-                if not client.ok:
-                    raise ClientResponseError(
-                        client.request_info,
-                        client.history,
-                        status=client.status)
-                json: dict = await client.json()
+            with REQUESTS_IN_FLIGHT.track():
+                started = time.perf_counter()
+                async with session.get(url) as client:
+                    if not client.ok:
+                        raise ClientResponseError(
+                            client.request_info,
+                            client.history,
+                            status=client.status)
+                    body = await client.read()
+                    UPSTREAM_SECONDS.observe(time.perf_counter() - started, method=method)
+                    with STAGE_SECONDS.time(stage="decode"):
+                        # json() decodes the body that has just been read, it does not read it again
+                        json: dict = await client.json() if decoder is None else decoder(body)
 
         except ClientResponseError as traceback:
             return form_error_json(error_code=traceback.status,
@@ -41,15 +340,26 @@ class AsyncRequest:
             return form_error_json(error_code=0,
                                    error_message=f"Timeout",
                                    details=f"The request or response took too long for {url}")
-        except JSONDecodeError:
-            return client.text()
+        except (JSONDecodeError, UnicodeDecodeError):
+            return form_error_json(error_code=0,
+                                   error_message=f"Invalid JSON",
+                                   details=f"Could not decode the response of {url}: {body[:200]!r}")
         return json
 
+    async def fetch(self, url, session):
+        """Fetches a single url through the scheduler."""
+        return await self.scheduler.schedule(self.fetch_content, url, session, decoder=self.decoder)
+
+    async def request(self, url, session):
+        """Fetches a single url through the response cache (if any) and the scheduler."""
+        if self.cache is None:
+            return await self.fetch(url, session)
+        return await self.cache.get_or_fetch(url, lambda: self.fetch(url, session))
+
     async def create_session(self, url_gen):
-        async with aiohttp.ClientSession() as session:
-            tasks = [self.fetch_content(url, session) for url in url_gen]
-            result = await asyncio.gather(*tasks)
-        return result
+        session = self.sessions.get_session()
+        tasks = [self.request(url, session) for url in url_gen]
+        return await asyncio.gather(*tasks)
 
     async def run(self) -> tp.List[dict]:
         return await self.create_session(self.coroutine)
@@ -58,6 +368,150 @@ class AsyncRequest:
         return asyncio.run(self.run())
 
 
+class BatchedAsyncRequest(AsyncRequest):
+    """Same as AsyncRequest, but packs the method calls into `execute` requests
+    and splits every combined reply back into one JSON per original call."""
+
+    def __init__(self, coroutine, *, batch_size: int = ExecuteAPI.MAX_CALLS, **request_options):
+        super().__init__(coroutine, **request_options)
+        self.batch_size = batch_size
+
+    @staticmethod
+    def split_execute_response(json, call_count: int) -> tp.List[dict]:
+        if not isinstance(json, dict) or not isinstance(json.get("response"), list):
+            # the whole execute call failed, so every packed call shares its error
+            return [json] * call_count
+
+        execute_errors = iter(json.get("execute_errors", ()))
+        result = []
+        for item in json["response"]:
+            if item is False:
+                error = next(execute_errors, None) or {"error_code": 0, "error_msg": "Unknown execute error"}
+                VK_ERRORS.inc(code=error.get("error_code", 0))
+                result.append({"error": error})
+            else:
+                result.append({"response": item})
+        return result
+
+    async def fetch_batched(self, url_list: tp.List[str]) -> tp.List[dict]:
+        if not url_list:
+            return []
+        batches = list(ExecuteAPI.batch(url_list, batch_size=self.batch_size))
+        session = self.sessions.get_session()
+        result = await asyncio.gather(*(self.fetch(url, session) for url, _ in batches))
+        return [json for (_, call_count), batch_json in zip(batches, result)
+                for json in self.split_execute_response(batch_json, call_count)]
+
+    async def create_session(self, url_gen):
+        url_list = list(url_gen)
+        if self.cache is None:
+            return await self.fetch_batched(url_list)
+
+        # only the calls that are neither cached nor already being fetched go into execute batches
+        result: tp.List[tp.Optional[dict]] = [None] * len(url_list)
+        in_flight: tp.Dict[int, asyncio.Future] = {}
+        missing: tp.Dict[int, str] = {}
+        for index, url in enumerate(url_list):
+            cached = self.cache.get(url)
+            if cached is not None:
+                result[index] = cached
+            elif self.cache.get_in_flight(url) is not None:
+                in_flight[index] = self.cache.get_in_flight(url)
+            else:
+                self.cache.begin(url)
+                missing[index] = url
+
+        try:
+            fetched = await self.fetch_batched(list(missing.values()))
+        except asyncio.CancelledError:
+            for url in missing.values():
+                self.cache.abandon(url)
+            raise
+        except BaseException as exception:
+            for url in missing.values():
+                self.cache.fail(url, exception)
+            raise
+        for (index, url), json in zip(missing.items(), fetched):
+            self.cache.complete(url, json)
+            result[index] = json
+        for index, future in in_flight.items():
+            json = await self.cache.wait(future)
+            if json is None:
+                # the request that was fetching it got cancelled
+                url = url_list[index]
+                json = await self.cache.get_or_fetch(url, lambda: self.fetch_one(url))
+            result[index] = json
+        return result
+
+    async def fetch_one(self, url: str) -> dict:
+        return (await self.fetch_batched([url]))[0]
+
+
+class PaginatedRequest(AsyncRequest):
+    """Fetches every page of an offset-paginated method.
+    The first page tells the total `count`; the remaining pages are requested concurrently,
+    with at most `pages_in_flight` of them fetched but not yet consumed."""
+
+    def __init__(self, page_url: tp.Callable[[int], str], *, page_size: int = DefaultRequestSettings.FRIENDS_PAGE_SIZE,
+                 pages_in_flight: int = DefaultRequestSettings.PAGES_IN_FLIGHT, **request_options):
+        super().__init__(page_url, **request_options)
+        self.page_size = page_size
+        self.pages_in_flight = pages_in_flight
+
+    @staticmethod
+    def get_total_count(json) -> tp.Optional[int]:
+        if not isinstance(json, dict) or not isinstance(json.get("response"), dict):
+            return None
+        return json["response"].get("count")
+
+    async def iter_pages(self, *, ordered: bool = False) -> tp.AsyncGenerator[dict, None]:
+        """Yields raw page JSONs in the order they arrive, the first page always goes first.
+        With `ordered` pages are yielded in offset order; a page that arrives early waits for the ones before it."""
+        session = self.sessions.get_session()
+        first_page = await self.request(self.coroutine(0), session)
+        yield first_page
+        total_count = self.get_total_count(first_page)
+        if not total_count:
+            return
+
+        offsets = iter(range(self.page_size, total_count, self.page_size))
+        if ordered:
+            async for page in self._iter_ordered_pages(offsets, session):
+                yield page
+            return
+        pending = set()
+        try:
+            while True:
+                for offset in offsets:
+                    pending.add(asyncio.ensure_future(self.request(self.coroutine(offset), session)))
+                    if len(pending) >= self.pages_in_flight:
+                        break
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _iter_ordered_pages(self, offsets: tp.Iterator[int], session) -> tp.AsyncGenerator[dict, None]:
+        pending: tp.Deque[asyncio.Future] = collections.deque()
+        try:
+            for offset in offsets:
+                pending.append(asyncio.ensure_future(self.request(self.coroutine(offset), session)))
+                if len(pending) >= self.pages_in_flight:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def run(self) -> tp.List[dict]:
+        return [page async for page in self.iter_pages()]
+
+
 if __name__ == "__main__":
     pass
 
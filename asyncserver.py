@@ -1,10 +1,15 @@
 import dataclasses
-from vk_parser import vk_parser
-from service_functions import execute_command
+import logging
+import typing as tp
+from service_functions import execute_command, command_error, analytics_executor, job_manager
 from representation_functions import StaticResponse
-import socket
+from network_settings import session_manager
+from config import ServerSettings
+from metrics import CONNECTIONS, serve_prometheus
 import asyncio
 
+logger = logging.getLogger(__name__)
+
 
 @dataclasses.dataclass
 class ClientAddress:
@@ -17,60 +22,188 @@ class ClientAddress:
 
 
 class AsyncServer:
-    default_buffer_size = 4096
-
-    def __init__(self, *, address: ClientAddress):
+    """Line-based command server built on asyncio streams.
+
+    Every line is a command. A client may pipeline up to `pipeline_depth` commands: they run concurrently,
+    but replies are sent back in the order the commands came in. When the limit is reached the server stops
+    reading from the client until the oldest reply is written, and every write waits for `drain()`, so a slow
+    client cannot make the server buffer unbounded data. At most `max_concurrent_commands` commands run
+    at the same time across all clients, and clients above `max_connections` are turned away.
+    Bulk `submit` commands return a job id at once and run in the background (see jobs.JobManager);
+    `status` and `fetch` report on them from any connection.
+    With `metrics_address` the metrics are also served in the Prometheus text format over HTTP;
+    the `stats` command returns them to any client.
+    With `reuse_port` several processes can listen on the same port (SO_REUSEPORT), see prefork.PreforkServer."""
+
+    def __init__(self, *, address: ClientAddress,
+                 max_connections: int = ServerSettings.MAX_CONNECTIONS,
+                 max_concurrent_commands: int = ServerSettings.MAX_CONCURRENT_COMMANDS,
+                 pipeline_depth: int = ServerSettings.PIPELINE_DEPTH,
+                 max_line_length: int = ServerSettings.MAX_LINE_LENGTH,
+                 metrics_address: tp.Optional[ClientAddress] = None,
+                 reuse_port: bool = False):
         self.address = address
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.event_loop = asyncio.get_event_loop()
-        self.__bind_server()
+        self.max_connections = max_connections
+        self.max_concurrent_commands = max_concurrent_commands
+        self.pipeline_depth = pipeline_depth
+        self.max_line_length = max_line_length
+        self.metrics_address = metrics_address
+        self.reuse_port = reuse_port
+        self.connection_count = 0
+        self._connection_tasks: tp.Set[asyncio.Task] = set()
+        self._reader_tasks: tp.Set[asyncio.Task] = set()
+        self._commands_semaphore: tp.Optional[asyncio.Semaphore] = None
+        self._server: tp.Optional[asyncio.AbstractServer] = None
+        self._stopping = False
+        self._drained: tp.Optional[asyncio.Event] = None
 
     @classmethod
-    def bind(cls, *, ip: str, port: int):
-        return cls(address=ClientAddress(ip=ip, port=port))
-
-    def __bind_server(self):
-        self.server_socket.bind(self.address.tuple)
-        self.server_socket.listen()
-        self.server_socket.setblocking(False)
-
-    async def accept_connection(self):
-        loop = asyncio.get_event_loop()
+    def bind(cls, *, ip: str, port: int, **settings):
+        return cls(address=ClientAddress(ip=ip, port=port), **settings)
+
+    async def start(self) -> asyncio.AbstractServer:
+        self._commands_semaphore = asyncio.Semaphore(self.max_concurrent_commands)
+        self._stopping = False
+        self._drained = asyncio.Event()
+        self._server = await asyncio.start_server(self.handle_client, *self.address.tuple,
+                                                  limit=self.max_line_length, reuse_port=self.reuse_port or None)
+        return self._server
+
+    async def shutdown(self, *, timeout: float = ServerSettings.DRAIN_TIMEOUT):
+        """Graceful drain: stops accepting connections and reading commands, sends the replies to the commands
+        that were already read and closes the connections. Connections still open after `timeout` are cut off.
+        `serve` releases the HTTP session and the job workers only once the drain is over."""
+        self._stopping = True
+        try:
+            if self._server is not None:
+                self._server.close()
+            for task in list(self._reader_tasks):
+                task.cancel()
+            if self._connection_tasks:
+                await asyncio.wait(set(self._connection_tasks), timeout=timeout)
+            for task in list(self._connection_tasks):
+                task.cancel()
+            await asyncio.gather(*self._connection_tasks, return_exceptions=True)
+        finally:
+            if self._drained is not None:
+                self._drained.set()
+
+    async def run_command(self, message: str):
+        """The reply to a command; a command that fails gets an error reply, so that the replies
+        to the other commands of the pipeline are still sent."""
+        async with self._commands_semaphore:
+            try:
+                return await execute_command(message)
+            except Exception as exception:
+                logger.exception("Command %r failed.", message)
+                return command_error(exception)
+
+    @staticmethod
+    async def send(writer: asyncio.StreamWriter, message: str):
+        writer.write((message + "\n").encode())
+        await writer.drain()
+
+    async def write_replies(self, writer: asyncio.StreamWriter, replies: asyncio.Queue,
+                            pipeline: asyncio.Semaphore):
         while True:
-            client, address = await loop.sock_accept(self.server_socket)
-            print(f"[+] Established connection with {address}.")
-            loop.create_task(self.read_from_client(client, address))
-
-    async def read_from_client(self, client, address):
-        ip, port = address
-        loop = asyncio.get_event_loop()
-        await loop.sock_sendall(client, (StaticResponse.greetings(ip_address=address)).encode())
+            task = await replies.get()
+            if task is None:
+                break
+            await self.send(writer, str(await task))
+            pipeline.release()
+
+    async def read_commands(self, reader: asyncio.StreamReader, replies: asyncio.Queue,
+                            pipeline: asyncio.Semaphore, address):
+        """Schedules every command read, once a slot of the pipeline is free."""
+        ip, port = address[:2]
         while True:
             try:
-                message = await loop.sock_recv(client, self.default_buffer_size)
-            except ConnectionResetError:
-                print(f"[-] {ip}, port {port} disconnected.")
+                line = await reader.readline()
+            except ValueError:
+                # the line did not fit into the stream buffer, framing cannot be recovered
+                await pipeline.acquire()
+                await replies.put(asyncio.ensure_future(self._static(StaticResponse.line_too_long(self.max_line_length))))
                 break
-            print(f"> Message from {ip}, port {port}: {message}")
-            message = await execute_command(message.decode())
-            value = vk_parser.FriendsParser(message)
-            print(value.parse())
-            message = str(message)
-            if not message:
+            except ConnectionError:
                 break
-            try:
-                await loop.sock_sendall(client, (message + "\n").encode())
-            except ConnectionAbortedError:
-                print(f"[-] {ip}, port {port} disconnected.")
+            if not line:
                 break
-
-        client.close()
+            message = line.decode(errors="replace").rstrip("\r\n")
+            logger.debug("Message from %s, port %s: %s", ip, port, message)
+            await pipeline.acquire()
+            await replies.put(asyncio.ensure_future(self.run_command(message)))
+
+    @staticmethod
+    async def _static(message: str) -> str:
+        return message
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")
+        ip, port = address[:2]
+        if self.connection_count >= self.max_connections:
+            try:
+                await self.send(writer, StaticResponse.server_busy())
+            finally:
+                writer.close()
+            return
+
+        self.connection_count += 1
+        self._connection_tasks.add(asyncio.current_task())
+        CONNECTIONS.inc()
+        logger.info("Established connection with %s.", address)
+        # commands read and not answered yet: the reader takes a slot before it schedules a command,
+        # the writer gives it back once the reply is sent
+        pipeline = asyncio.Semaphore(self.pipeline_depth)
+        replies: asyncio.Queue = asyncio.Queue()
+        reader_task = writer_task = None
+        try:
+            await self.send(writer, StaticResponse.greetings(ip_address=address))
+            writer_task = asyncio.ensure_future(self.write_replies(writer, replies, pipeline))
+            reader_task = asyncio.ensure_future(self.read_commands(reader, replies, pipeline, address))
+            self._reader_tasks.add(reader_task)
+            await asyncio.wait({reader_task, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+            if not writer_task.done():
+                # the client stopped sending: answer what is already in the pipeline
+                await replies.put(None)
+                await writer_task
+            writer_task.result()
+        except ConnectionError:
+            pass
+        finally:
+            while not replies.empty():
+                task = replies.get_nowait()
+                if task is not None:
+                    task.cancel()
+            for task in (reader_task, writer_task):
+                if task is not None:
+                    task.cancel()
+            self._reader_tasks.discard(reader_task)
+            self._connection_tasks.discard(asyncio.current_task())
+            self.connection_count -= 1
+            CONNECTIONS.dec()
+            logger.info("%s, port %s disconnected.", ip, port)
+            writer.close()
+
+    async def serve(self):
+        server = await self.start()
+        metrics_runner = None
+        if self.metrics_address is not None:
+            metrics_runner = await serve_prometheus(host=self.metrics_address.ip, port=self.metrics_address.port)
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            if not self._stopping:
+                raise
+            # shutdown() closed the server, which stops serve_forever; the open connections still
+            # need the session and the job workers until they are drained
+            await self._drained.wait()
+        finally:
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await job_manager.close()
+            await session_manager.close()
+            analytics_executor.shutdown(wait=False)
 
     def listen(self):
-        asyncio.run(self.accept_connection())
-
-
-
-
-
-
+        asyncio.run(self.serve())
@@ -0,0 +1,256 @@
+"""Throughput of the whole pipeline on synthetic data, with no token and no network.
+
+    python -m benchmarks.bench_suite [--sizes 1000 10000 100000] [--output run.json] [--compare baseline.json]
+
+`fetch` goes through the local mock API (latency, error 6 injection, pagination, execute batching);
+every other benchmark runs on seeded friends.get payloads of each size. The best time of `--repeat`
+runs is reported. Save a run of one commit with `--output` and pass it to `--compare` on another
+commit to get the speedup of every benchmark; keep the sizes and the seed the same between the two.
+10^6 profiles need several gigabytes of memory for the validated models.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import typing as tp
+from asyncrequest import BatchedAsyncRequest, PaginatedRequest, RequestScheduler, TokenPool, decode_json
+from config import FriendsAPI, RateLimitSettings
+from service_functions import ProfileTransformedList, parse_birth_date
+from vk_parser.vk_parser import FriendsParser, GroupingField, GroupingIndex
+from vk_parser.aggregators import TopKAggregator
+from vk_parser.pydantic_models import Profile, trusted_construct
+from vk_parser.query_plan import Analytics, plan_query, SUMMARY_ANALYTICS
+from benchmarks.generator import VKDataGenerator
+from benchmarks.mock_api import MockVKAPI, MockSettings
+
+try:
+    from vk_parser.profile_frame import ProfileFrame
+except ImportError:
+    ProfileFrame = None
+
+DEFAULT_SIZES = (1000, 10_000, 100_000)
+
+
+class BenchmarkResult(tp.NamedTuple):
+    name: str
+    size: int
+    seconds: float
+    extra: tp.Dict[str, tp.Any] = {}
+
+    @property
+    def key(self) -> str:
+        return f"{self.name}[{self.size}]"
+
+    @property
+    def per_item_us(self) -> float:
+        return self.seconds / self.size * 1e6 if self.size else 0.0
+
+
+@contextlib.contextmanager
+def quiet():
+    """The measured code still prints its debug output; it goes nowhere instead of flooding the report."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def best_time(func: tp.Callable[[], tp.Any], *, repeat: int,
+              setup: tp.Optional[tp.Callable[[], tp.Any]] = None) -> float:
+    """Best wall time of `repeat` calls; `setup` builds the argument of every call outside the measurement."""
+    best = float("inf")
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        gc.collect()
+        started = time.perf_counter()
+        with quiet():
+            func(argument) if setup is not None else func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_decode_validate(body: bytes, size: int, *, repeat: int) -> tp.List[BenchmarkResult]:
+    return [
+        BenchmarkResult("decode+validate", size,
+                        best_time(lambda: list(FriendsParser.iter_items(json.loads(body))), repeat=repeat)),
+        BenchmarkResult("decode+validate eager", size,
+                        best_time(lambda: FriendsParser([json.loads(body)]).response, repeat=repeat)),
+        BenchmarkResult("decode+trusted", size,
+                        best_time(lambda: list(FriendsParser.iter_items(decode_json(body), trusted=True)),
+                                  repeat=repeat)),
+    ]
+
+
+def bench_projection(generator: VKDataGenerator, size: int, *, repeat: int) -> tp.List[BenchmarkResult]:
+    """decode+validate of the same users with only the fields of a query plan: the "friends" summary
+    and a surname search; `full_bytes` is the size of the reply with every field."""
+    full_bytes = len(json.dumps(generator.friends_response(size), ensure_ascii=False).encode())
+    results = []
+    for name, plan in (("summary", plan_query(*SUMMARY_ANALYTICS)), ("surname", plan_query(Analytics.SURNAME))):
+        body = json.dumps(generator.friends_response(size, fields=plan.fields), ensure_ascii=False).encode()
+        results.append(BenchmarkResult(f"decode+validate {name} plan", size,
+                                       best_time(lambda: list(plan.parser.iter_items(json.loads(body))),
+                                                 repeat=repeat),
+                                       {"fields": plan.fields, "bytes": len(body), "full_bytes": full_bytes}))
+    return results
+
+
+def bench_transform(items: tp.List[dict], size: int, *, repeat: int) -> tp.List[BenchmarkResult]:
+    def setup():
+        parse_birth_date.cache_clear()
+        return [trusted_construct(Profile, item) for item in items]
+
+    return [BenchmarkResult("ProfileTransformedList", size,
+                            best_time(lambda profiles: ProfileTransformedList(iterable=profiles),
+                                      repeat=repeat, setup=setup))]
+
+
+def bench_analytics(profiles: tp.List[Profile], size: int, *, repeat: int) -> tp.List[BenchmarkResult]:
+    with quiet():
+        group_by = FriendsParser([{"response": {"count": 0, "items": []}}]).group_by
+    results = [
+        BenchmarkResult("group_by city", size,
+                        best_time(lambda: [(key, list(group)) for key, group in
+                                           group_by(profiles, group_field=GroupingField.CITY)],
+                                  repeat=repeat)),
+        BenchmarkResult("GroupingIndex city", size,
+                        best_time(lambda: GroupingIndex(profiles).groups(GroupingField.CITY), repeat=repeat)),
+        BenchmarkResult("top university", size,
+                        best_time(lambda: FriendsParser.get_most_frequent_university(profiles, top_count=3),
+                                  repeat=repeat)),
+        BenchmarkResult("top city", size,
+                        best_time(lambda: FriendsParser.get_most_frequent_city(profiles), repeat=repeat)),
+        BenchmarkResult("TopKAggregator", size,
+                        best_time(lambda: TopKAggregator().update(profiles).get_most_frequent_university(top_count=3),
+                                  repeat=repeat)),
+    ]
+    if ProfileFrame is not None:
+        results.append(BenchmarkResult("ProfileFrame build", size,
+                                       best_time(lambda: ProfileFrame.from_profiles(profiles), repeat=repeat)))
+        frame = ProfileFrame.from_profiles(profiles)
+        results.append(BenchmarkResult("ProfileFrame group_by city", size,
+                                       best_time(lambda: frame.group_counts(group_field=GroupingField.CITY),
+                                                 repeat=repeat)))
+        results.append(BenchmarkResult("ProfileFrame top university", size,
+                                       best_time(lambda: frame.get_most_frequent_university(top_count=3),
+                                                 repeat=repeat)))
+    return results
+
+
+async def bench_fetch(generator: VKDataGenerator, *, users: int, latency: float, error_rate: float,
+                      requests_per_second: float, page_size: int, tokens: int = 1) -> tp.List[BenchmarkResult]:
+    """Wall time of the "friends" command path (execute batches) and of a paginated friend list.
+    With several `tokens` the requests are spread over a pool, each token with its own `requests_per_second`."""
+    burst = max(RateLimitSettings.BURST, int(requests_per_second))
+    pool = TokenPool([f"token-{index}" for index in range(tokens)], requests_per_second=requests_per_second,
+                     burst=burst) if tokens > 1 else None
+    scheduler = RequestScheduler(requests_per_second=requests_per_second, burst=burst, token_pool=pool)
+    results = []
+    async with MockVKAPI(generator, latency=latency, error_rate=error_rate, seed=generator.seed) as api:
+        async with api.session_manager() as sessions:
+            user_ids = [str(user_id) for user_id in range(1, users + 1)]
+            started = time.perf_counter()
+            response_list = await BatchedAsyncRequest(FriendsAPI.get(user_ids), scheduler=scheduler,
+                                                      sessions=sessions, decoder=decode_json).run()
+            seconds = time.perf_counter() - started
+            profile_count = sum(len(json_["response"]["items"]) for json_ in response_list if "response" in json_)
+            results.append(BenchmarkResult("fetch execute", users, seconds,
+                                           {"profiles": profile_count, **api.stats._asdict()}))
+
+            api.reset_stats()
+            user_id = max(range(1, users + 1), key=generator.friend_count)
+            request = PaginatedRequest(lambda offset: FriendsAPI.get_page(user_id, count=page_size, offset=offset),
+                                       page_size=page_size, scheduler=scheduler, sessions=sessions,
+                                       decoder=decode_json)
+            started = time.perf_counter()
+            pages = await request.run()
+            seconds = time.perf_counter() - started
+            profile_count = sum(len(json_["response"]["items"]) for json_ in pages if "response" in json_)
+            results.append(BenchmarkResult("fetch paginated", profile_count, seconds, api.stats._asdict()))
+    return results
+
+
+def git_revision() -> tp.Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace) -> tp.List[BenchmarkResult]:
+    generator = VKDataGenerator(seed=args.seed)
+    results = asyncio.run(bench_fetch(generator, users=args.users, latency=args.latency, error_rate=args.error_rate,
+                                      requests_per_second=args.rps, page_size=args.page_size,
+                                      tokens=args.tokens))
+    for size in args.sizes:
+        payload = generator.friends_response(size)
+        body = json.dumps(payload, ensure_ascii=False).encode()
+        results.extend(bench_decode_validate(body, size, repeat=args.repeat))
+        results.extend(bench_projection(generator, size, repeat=args.repeat))
+        results.extend(bench_transform(payload["response"]["items"], size, repeat=args.repeat))
+        profiles = list(FriendsParser.iter_items(payload))
+        del payload, body
+        results.extend(bench_analytics(profiles, size, repeat=args.repeat))
+    return results
+
+
+def report(results: tp.List[BenchmarkResult], baseline: tp.Optional[dict] = None):
+    baseline_results = (baseline or {}).get("results", {})
+    header = f"{'benchmark':<32} {'size':>8} {'seconds':>10} {'us/item':>10}"
+    print(header + (f" {'baseline':>10} {'speedup':>8}" if baseline else ""))
+    for result in results:
+        line = f"{result.name:<32} {result.size:>8} {result.seconds:>10.4f} {result.per_item_us:>10.3f}"
+        if baseline:
+            previous = baseline_results.get(result.key, {}).get("seconds")
+            line += f" {previous:>10.4f} {previous / result.seconds:>7.2f}x" if previous else f" {'-':>10} {'-':>8}"
+        if result.extra:
+            line += "  " + " ".join(f"{key}={value}" for key, value in result.extra.items())
+        print(line)
+
+
+def to_json(results: tp.List[BenchmarkResult], args: argparse.Namespace) -> dict:
+    return {"meta": {"revision": git_revision(), "python": platform.python_version(),
+                     "platform": platform.platform(), "created_at": time.time(),
+                     "arguments": {key: value for key, value in vars(args).items()
+                                   if key not in ("output", "compare")}},
+            "results": {result.key: {"seconds": result.seconds, "per_item_us": result.per_item_us, **result.extra}
+                        for result in results}}
+
+
+def parse_args(argv: tp.List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_suite", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="profiles per payload")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=100, help="users fetched by the fetch benchmarks")
+    parser.add_argument("--latency", type=float, default=MockSettings.LATENCY, help="mock API latency, seconds")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="share of requests answered with error 6")
+    parser.add_argument("--rps", type=float, default=RateLimitSettings.REQUESTS_PER_SECOND,
+                        help="requests per second allowed by the scheduler, per access token")
+    parser.add_argument("--tokens", type=int, default=1, help="access tokens the fetch benchmarks spread requests over")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    results = run(args)
+    report(results, baseline)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(to_json(results, args), file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
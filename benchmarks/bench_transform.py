@@ -0,0 +1,69 @@
+"""Per-profile cost of ProfileTransformedList: the reflective multi-pass implementation it replaced
+against the registered single-pass pipeline.
+
+    python -m benchmarks.bench_transform [profile count]
+"""
+import re
+import sys
+import time
+import typing as tp
+from service_functions import BaseDataTransformer, BirthDate, ProfileTransformedList, PLATFORM_NAMES, parse_birth_date
+from vk_parser.pydantic_models import Profile, trusted_construct
+from benchmarks.generator import VKDataGenerator
+
+
+class LegacyProfileTransformedList(BaseDataTransformer):
+    """The implementation before the compiled pipeline, kept only as the baseline of this benchmark."""
+
+    @BaseDataTransformer.iterable.setter
+    def iterable(self, iterable):
+        method_list = filter(lambda func:
+                             callable(getattr(type(self), func)) and not func.startswith("__"), dir(self))
+        for method in method_list:
+            getattr(self, method)(iterable)
+        super(LegacyProfileTransformedList, LegacyProfileTransformedList).iterable.__set__(self, iterable)
+
+    @staticmethod
+    def _parse_birth_date(target_list: tp.List[Profile]):
+        pattern = re.compile(r"^(\d{1,2})[.-](\d{1,2})[.-](\d\d\d\d)$")
+
+        for profile in filter(lambda user: user.bdate is not None, target_list):
+            result = pattern.search(profile.bdate)
+            if result:
+                profile.bdate = BirthDate(*(int(value) for value in result.groups()))
+            else:
+                profile.bdate = BirthDate(*(int(value) for value in re.split(r'[\.-]', profile.bdate)))
+
+    @staticmethod
+    def _parse_platform(target_list: tp.List[Profile]):
+        for profile in filter(lambda user: user.last_seen and user.last_seen.platform, target_list):
+            profile.last_seen.platform = PLATFORM_NAMES.get(profile.last_seen.platform, None)
+
+
+def measure(transformer: tp.Type[BaseDataTransformer], items: tp.List[dict], *, chunk_size: int,
+            repeat: int = 5) -> float:
+    """Best per-profile time in microseconds; the list is wrapped in chunks, as streaming ingestion does."""
+    count = len(items)
+    best = float("inf")
+    for _ in range(repeat):
+        profiles = [trusted_construct(Profile, item) for item in items]
+        chunks = [profiles[start:start + chunk_size] for start in range(0, count, chunk_size)]
+        parse_birth_date.cache_clear()
+        started = time.perf_counter()
+        for chunk in chunks:
+            transformer(iterable=chunk)
+        best = min(best, time.perf_counter() - started)
+    return best / count * 1e6
+
+
+def main(count: int = 100_000):
+    items = VKDataGenerator().friends_response(count)["response"]["items"]
+    print(f"{'chunk size':>10} {'legacy, us':>11} {'pipeline, us':>13} {'speedup':>8}")
+    for chunk_size in (1, 100, count):
+        legacy = measure(LegacyProfileTransformedList, items, chunk_size=chunk_size)
+        pipeline = measure(ProfileTransformedList, items, chunk_size=chunk_size)
+        print(f"{chunk_size:>10} {legacy:>11.3f} {pipeline:>13.3f} {legacy / pipeline:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
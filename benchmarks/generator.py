@@ -0,0 +1,186 @@
+"""Seeded generator of synthetic VK API payloads.
+
+Every user, friend list and photo album is derived from the seed and the user id alone, so the same
+payload comes out on every run and any page can be built without building the pages before it.
+"""
+import functools
+import itertools
+import random
+import typing as tp
+
+CITIES = ("Moscow", "Saint Petersburg", "Novosibirsk", "Yekaterinburg", "Kazan", "Nizhny Novgorod",
+          "Chelyabinsk", "Samara", "Omsk", "Rostov-on-Don", "Ufa", "Krasnoyarsk", "Voronezh", "Perm",
+          "Volgograd", "Krasnodar", "Saratov", "Tyumen", "Makhachkala", "Stavropol", "Ulan-Ude", "Veliky Novgorod")
+UNIVERSITIES = ("МГУ", "СПбГУ", "МФТИ", "ВШЭ", "МГТУ им. Н.Э. Баумана", "РГМУ им. Н.И. Пирогова", "МГМСУ",
+                "НГУ", "КФУ", "УрФУ", "ДГМА", "Первый МГМУ им. И.М. Сеченова", "ТГУ", "СГАУ", "КрасГМУ")
+FACULTIES = ("Лечебный факультет", "Механико-математический факультет", "Экономический факультет",
+             "Юридический факультет", "Факультет вычислительной математики и кибернетики")
+EMPLOYERS = ("ПАО Сбербанк", "Яндекс", "ГКБ №1 им. Н.И. Пирогова", "РЖД", "ООО Ромашка", "Сеть клиник МЕДСИ",
+             "Ozon", "Газпром", "Школа №57", "Фриланс")
+FIRST_NAMES = {1: ("Anna", "Maria", "Olga", "Elena", "Irina", "Tatyana", "Natalia", "Anastasia", "Ekaterina"),
+               2: ("Alexander", "Sergey", "Dmitry", "Andrey", "Alexey", "Ivan", "Mikhail", "Oleg", "Murad")}
+LAST_NAME_ROOTS = ("Ivan", "Petr", "Smirn", "Kuznets", "Sokol", "Popov", "Lebed", "Kozl", "Novik", "Moroz",
+                   "Volk", "Alek", "Gus", "Orl", "Vasil", "Zaits", "Pavl", "Semen", "Golub", "Vinogrado")
+LAST_NAME_SUFFIXES = {1: ("ova", "eva", "ina", "skaya"), 2: ("ov", "ev", "in", "skiy")}
+# names that match none of the suffix rules of FriendsParser.get_people_with_the_same_last_name
+PLAIN_LAST_NAMES = ("Kim", "Smol", "Tsoi", "Alg", "Nikitkin")
+DEACTIVATED = ("deleted", "banned")
+LAST_SEEN_TIME = 1693400000
+PHOTO_TIME_SPAN = 3 * 365 * 24 * 3600
+# keys VK returns whatever `fields` are requested
+BASE_PROFILE_KEYS = frozenset(("id", "first_name", "last_name", "can_access_closed", "is_closed", "track_code",
+                               "deactivated"))
+# profile keys of the `fields` values that are named differently
+FIELD_KEYS = {"contacts": ("mobile_phone", "home_phone")}
+
+
+def zipf_weights(count: int, *, exponent: float = 1.1) -> tp.List[float]:
+    """Cumulative weights of a Zipf distribution: a few cities and universities hold most of the users."""
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+CITY_WEIGHTS = zipf_weights(len(CITIES))
+UNIVERSITY_WEIGHTS = zipf_weights(len(UNIVERSITIES))
+PLATFORM_WEIGHTS = list(itertools.accumulate((8, 25, 3, 40, 1, 3, 20)))
+
+
+class VKDataGenerator:
+    """Builds friends.get, friends.getMutual and photos.getUserPhotos replies for synthetic users.
+
+    Users have ids from 1 to `population` and belong to communities of `community_size` consecutive ids;
+    most friends of a user come from their own community, so friend lists overlap, as mutual-friends
+    queries and the crawler need. Friendship is not kept symmetric."""
+
+    def __init__(self, *, seed: int = 0, population: int = 10 ** 7, community_size: int = 2000,
+                 friend_count_range: tp.Tuple[int, int] = (20, 1500),
+                 photo_count_range: tp.Tuple[int, int] = (0, 300)):
+        self.seed = seed
+        self.population = population
+        self.community_size = community_size
+        self.friend_count_range = friend_count_range
+        self.photo_count_range = photo_count_range
+        self.friend_ids = functools.lru_cache(maxsize=1024)(self._friend_ids)
+
+    def rng(self, *key: int) -> random.Random:
+        return random.Random(hash((self.seed, *key)))
+
+    def profile(self, user_id: int) -> dict:
+        rnd = self.rng(0, user_id)
+        sex = rnd.choice((1, 2))
+        if rnd.random() < 0.9:
+            last_name = rnd.choice(LAST_NAME_ROOTS) + rnd.choice(LAST_NAME_SUFFIXES[sex])
+        else:
+            last_name = rnd.choice(PLAIN_LAST_NAMES)
+        profile = {"id": user_id, "first_name": rnd.choice(FIRST_NAMES[sex]), "last_name": last_name,
+                   "sex": sex, "can_access_closed": True, "is_closed": rnd.random() < 0.15,
+                   "track_code": f"{rnd.getrandbits(64):016x}"}
+        if rnd.random() < 0.02:
+            profile["deactivated"] = rnd.choice(DEACTIVATED)
+            return profile
+
+        if rnd.random() < 0.7:
+            profile["bdate"] = f"{rnd.randint(1, 28)}.{rnd.randint(1, 12)}"
+            if rnd.random() < 0.6:
+                profile["bdate"] += f".{rnd.randint(1960, 2008)}"
+        if rnd.random() < 0.75:
+            city_id = rnd.choices(range(len(CITIES)), cum_weights=CITY_WEIGHTS)[0]
+            profile["city"] = {"id": city_id + 1, "title": CITIES[city_id]}
+        if rnd.random() < 0.95:
+            platform = rnd.choices(range(1, 8), cum_weights=PLATFORM_WEIGHTS)[0]
+            profile["last_seen"] = {"platform": platform, "time": LAST_SEEN_TIME - rnd.randrange(10 ** 8)}
+        if rnd.random() < 0.3:
+            profile["mobile_phone"] = rnd.choice(("", "+7900" + f"{rnd.randrange(10 ** 7):07d}"))
+            profile["about"] = ""
+
+        universities = [self.university(rnd) for _ in range(rnd.choice((0, 0, 0, 1, 1, 2)))]
+        if universities:
+            profile["universities"] = universities
+        if universities and rnd.random() < 0.5:
+            university = rnd.choice(universities)
+            profile["occupation"] = {"id": university["id"], "name": university["name"], "type": "university",
+                                     "graduate_year": university["graduation"], "country_id": 1,
+                                     "city_id": university["city"]}
+        elif rnd.random() < 0.5:
+            employer = rnd.randrange(len(EMPLOYERS))
+            profile["occupation"] = {"id": 1000 + employer, "name": EMPLOYERS[employer], "type": "work"}
+        return profile
+
+    @staticmethod
+    def project(profile: dict, fields: tp.Optional[str]) -> dict:
+        """The profile as friends.get returns it for `fields` (a comma-separated list); None keeps every key."""
+        if fields is None:
+            return profile
+        keys = set(BASE_PROFILE_KEYS)
+        for field in fields.split(","):
+            keys.update(FIELD_KEYS.get(field, (field,)))
+        return {key: value for key, value in profile.items() if key in keys}
+
+    @staticmethod
+    def university(rnd: random.Random) -> dict:
+        university_id = rnd.choices(range(len(UNIVERSITIES)), cum_weights=UNIVERSITY_WEIGHTS)[0]
+        faculty_id = rnd.randrange(len(FACULTIES))
+        return {"id": university_id + 1, "name": UNIVERSITIES[university_id], "city": rnd.randint(1, len(CITIES)),
+                "country": 1, "faculty": faculty_id + 1, "faculty_name": FACULTIES[faculty_id],
+                "graduation": rnd.randint(1985, 2024), "education_form": "Full-time",
+                "education_status": rnd.choice(("Alumnus (Specialist)", "Student (Bachelor's)"))}
+
+    def friend_count(self, user_id: int) -> int:
+        low, high = self.friend_count_range
+        # heavy tail: most users have a few dozen friends, some come close to the limit
+        return min(high, int(low * self.rng(1, user_id).paretovariate(1.2)))
+
+    def _friend_ids(self, user_id: int) -> tp.List[int]:
+        rnd = self.rng(2, user_id)
+        friend_ids = set()
+        count = self.friend_count(user_id)
+        community_start = (user_id - 1) // self.community_size * self.community_size + 1
+        community_end = min(community_start + self.community_size - 1, self.population)
+        while len(friend_ids) < count:
+            if rnd.random() < 0.8:
+                friend_id = rnd.randint(community_start, community_end)
+            else:
+                friend_id = rnd.randint(1, self.population)
+            if friend_id != user_id:
+                friend_ids.add(friend_id)
+        return sorted(friend_ids)
+
+    def friends_get(self, user_id: int, *, count: int = 5000, offset: int = 0,
+                    fields: tp.Optional[str] = None) -> dict:
+        friend_ids = self.friend_ids(user_id)
+        return {"response": {"count": len(friend_ids),
+                             "items": [self.project(self.profile(friend_id), fields)
+                                       for friend_id in friend_ids[offset:offset + count]]}}
+
+    def friends_get_mutual(self, source: int, targets: tp.Iterable[int]) -> dict:
+        source_friends = set(self.friend_ids(source))
+        items = []
+        for target in targets:
+            common_friends = [friend_id for friend_id in self.friend_ids(target) if friend_id in source_friends]
+            items.append({"id": target, "common_friends": common_friends, "common_count": len(common_friends)})
+        return {"response": items}
+
+    def photo_count(self, user_id: int) -> int:
+        return self.rng(3, user_id).randint(*self.photo_count_range)
+
+    def photo(self, user_id: int, index: int, total: int) -> dict:
+        """The photo of the `index`-th newest of the `total` tags of a user. Photos are often tagged long
+        after they were uploaded, so `date` is only loosely related to the order of the tags."""
+        rnd = self.rng(4, user_id, index)
+        owner_id = rnd.randint(1, self.population)
+        tagged = LAST_SEEN_TIME - (index * PHOTO_TIME_SPAN + rnd.randrange(PHOTO_TIME_SPAN)) // total
+        date = tagged - rnd.randrange(PHOTO_TIME_SPAN // 10) if rnd.random() < 0.5 else tagged
+        return {"album_id": rnd.choice((-7, -6, rnd.randint(1, 10 ** 6))), "id": 456239000 + index,
+                "owner_id": owner_id, "date": date,
+                "post_id": rnd.randint(1, 10 ** 5), "text": "", "tags_count": rnd.randint(0, 5)}
+
+    def photos_get_user_photos(self, user_id: int, *, count: int = 1000, offset: int = 0) -> dict:
+        total = self.photo_count(user_id)
+        # newest tag first, as VK returns them
+        return {"response": {"count": total, "items": [self.photo(user_id, index, total)
+                                                       for index in range(offset, min(offset + count, total))]}}
+
+    def friends_response(self, profile_count: int, *, first_id: int = 1, fields: tp.Optional[str] = None) -> dict:
+        """A single friends.get reply with `profile_count` consecutive users, for offline benchmarks."""
+        return {"response": {"count": profile_count,
+                             "items": [self.project(self.profile(user_id), fields)
+                                       for user_id in range(first_id, first_id + profile_count)]}}
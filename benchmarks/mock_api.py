@@ -0,0 +1,193 @@
+"""Local aiohttp stand-in for api.vk.com, serving VKDataGenerator payloads.
+
+    async with MockVKAPI(latency=0.05, error_rate=0.1) as api:
+        request = AsyncRequest(url_list, sessions=api.session_manager())
+        ...
+
+The request classes build https://api.vk.com URLs themselves, so the sessions handed out by
+`session_manager()` send every request to the mock instead.
+"""
+import asyncio
+import json
+import random
+import re
+import typing as tp
+import aiohttp
+from aiohttp import web
+from config import VKErrorCode
+from network_settings import SessionManager
+from benchmarks.generator import VKDataGenerator
+
+VK_API_ORIGIN = "https://api.vk.com"
+EXECUTE_VARIABLE_PATTERN = re.compile(r'var (v\d+)=("(?:[^"\\]|\\.)*");')
+EXECUTE_CALL_PATTERN = re.compile(r'API\.([\w.]+)\((\{.*?\})\)(?=[,\]])')
+EXECUTE_ARGUMENT_VARIABLE_PATTERN = re.compile(r':(v\d+)(?=[,}])')
+
+
+class MockSettings(tp.NamedTuple):
+    HOST = "127.0.0.1"
+    LATENCY = 0.05
+    JITTER = 0.01
+    ERROR_RATE = 0.0
+
+
+class MockStats(tp.NamedTuple):
+    requests: int
+    calls: int
+    injected_errors: int
+
+
+def parse_execute_code(code: str) -> tp.List[tp.Tuple[str, tp.Dict[str, str]]]:
+    """Reverses ExecuteAPI.form_code: the (method, params) pairs packed into an execute request."""
+    variables = dict(EXECUTE_VARIABLE_PATTERN.findall(code))
+    calls = []
+    for method, arguments in EXECUTE_CALL_PATTERN.findall(code):
+        arguments = EXECUTE_ARGUMENT_VARIABLE_PATTERN.sub(lambda match: ":" + variables[match.group(1)], arguments)
+        calls.append((method, json.loads(arguments)))
+    return calls
+
+
+class _RedirectingSession:
+    """Sends the requests made to api.vk.com to the mock; everything else goes through unchanged."""
+
+    def __init__(self, session: aiohttp.ClientSession, base_url: str):
+        self._session = session
+        self._base_url = base_url
+
+    def get(self, url: str, **kwargs):
+        if url.startswith(VK_API_ORIGIN):
+            url = self._base_url + url[len(VK_API_ORIGIN):]
+        return self._session.get(url, **kwargs)
+
+    @property
+    def closed(self) -> bool:
+        return self._session.closed
+
+    async def close(self):
+        await self._session.close()
+
+
+class MockSessionManager(SessionManager):
+    def __init__(self, base_url: str, **settings):
+        super().__init__(**settings)
+        self.base_url = base_url
+
+    def _create_session(self):
+        return _RedirectingSession(super()._create_session(), self.base_url)
+
+
+class MockVKAPI:
+    """Serves friends.get, friends.getMutual, photos.getUserPhotos and execute (with up to 25 of those)
+    with offset/count pagination. Every request is delayed by `latency` ± `jitter` seconds and answered
+    with error 6 ("Too many requests per second") with probability `error_rate`."""
+
+    def __init__(self, generator: tp.Optional[VKDataGenerator] = None, *, host: str = MockSettings.HOST,
+                 port: int = 0, latency: float = MockSettings.LATENCY, jitter: float = MockSettings.JITTER,
+                 error_rate: float = MockSettings.ERROR_RATE, seed: int = 0,
+                 token_errors: tp.Optional[tp.Dict[str, int]] = None):
+        self.generator = generator or VKDataGenerator(seed=seed)
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.token_errors = dict(token_errors or {})
+        self._random = random.Random(seed)
+        self._runner: tp.Optional[web.AppRunner] = None
+        self.requests = self.calls = self.injected_errors = 0
+        self.methods: tp.Dict[str, tp.Callable[[tp.Dict[str, str]], dict]] = {
+            "friends.get": self.friends_get,
+            "friends.getMutual": self.friends_get_mutual,
+            "photos.getUserPhotos": self.photos_get_user_photos,
+        }
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def stats(self) -> MockStats:
+        return MockStats(self.requests, self.calls, self.injected_errors)
+
+    def reset_stats(self):
+        self.requests = self.calls = self.injected_errors = 0
+
+    def session_manager(self, **settings) -> MockSessionManager:
+        return MockSessionManager(self.base_url, **settings)
+
+    @staticmethod
+    def error(error_code: int, error_msg: str) -> dict:
+        return {"error": {"error_code": error_code, "error_msg": error_msg}}
+
+    def friends_get(self, params: tp.Dict[str, str]) -> dict:
+        return self.generator.friends_get(int(params["user_id"]), count=int(params.get("count", 5000)),
+                                          offset=int(params.get("offset", 0)), fields=params.get("fields"))
+
+    def friends_get_mutual(self, params: tp.Dict[str, str]) -> dict:
+        targets = params.get("target_uids") or params["target_uid"]
+        return self.generator.friends_get_mutual(int(params["source_uid"]),
+                                                 [int(target) for target in targets.split(",")])
+
+    def photos_get_user_photos(self, params: tp.Dict[str, str]) -> dict:
+        return self.generator.photos_get_user_photos(int(params["user_id"]), count=int(params.get("count", 20)),
+                                                     offset=int(params.get("offset", 0)))
+
+    def call(self, method: str, params: tp.Dict[str, str]) -> dict:
+        self.calls += 1
+        if method not in self.methods:
+            return self.error(3, "Unknown method passed")
+        return self.methods[method](params)
+
+    def execute(self, params: tp.Dict[str, str]) -> dict:
+        response, execute_errors = [], []
+        for method, call_params in parse_execute_code(params["code"]):
+            json_ = self.call(method, call_params)
+            if "error" in json_:
+                response.append(False)
+                execute_errors.append({"method": method, **json_["error"]})
+            else:
+                response.append(json_["response"])
+        result = {"response": response}
+        if execute_errors:
+            result["execute_errors"] = execute_errors
+        return result
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+        params = dict(request.query)
+        token_error = self.token_errors.get(params.get("access_token"))
+        if token_error is not None:
+            self.injected_errors += 1
+            result = self.error(token_error, "Injected access token error")
+        elif self._random.random() < self.error_rate:
+            self.injected_errors += 1
+            result = self.error(VKErrorCode.TOO_MANY_REQUESTS, "Too many requests per second")
+        elif request.match_info["method"] == "execute":
+            result = self.execute(params)
+        else:
+            result = self.call(request.match_info["method"], params)
+        return web.json_response(result, dumps=lambda value: json.dumps(value, ensure_ascii=False))
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/method/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if not self.port:
+            self.port = self._runner.addresses[0][1]
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
@@ -1,7 +1,11 @@
 import os
+import tempfile
+import zoneinfo
 import typing as tp
 import ast
 import collections
+import json
+from urllib.parse import urlsplit, parse_qsl, urlencode
 
 
 CommandType = collections.namedtuple("Command", ["command", "args"])
@@ -16,21 +20,125 @@ def form_error_json(*, error_code, error_message, details=None) -> dict:
 
 class API(tp.NamedTuple):
     ACCESS_TOKEN = os.getenv("TOKEN")
+    # requests are spread over all of these tokens: TOKENS is a comma-separated list, TOKEN alone is a pool of one
+    ACCESS_TOKENS = tuple(token.strip() for token in (os.getenv("TOKENS") or os.getenv("TOKEN") or "").split(",")
+                          if token.strip())
     VERSION = 5.131
 
 
+class VKErrorCode(tp.NamedTuple):
+    AUTHORIZATION_FAILED = 5
+    TOO_MANY_REQUESTS = 6
+    FLOOD_CONTROL = 9
+
+
+class RateLimitSettings(tp.NamedTuple):
+    REQUESTS_PER_SECOND = 3
+    BURST = 3
+    MAX_CONCURRENCY = 10
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 30.0
+
+
+class TokenPoolSettings(tp.NamedTuple):
+    # a token that got "Flood control" (9) or "User authorization failed" (5) is not used for this long, seconds
+    FLOOD_COOLDOWN = 30.0
+    AUTH_COOLDOWN = 600.0
+    # requests per token per 24 hours, None for no limit
+    DAILY_LIMIT = int(os.getenv("TOKEN_DAILY_LIMIT")) if os.getenv("TOKEN_DAILY_LIMIT") else None
+
+
+class CacheSettings(tp.NamedTuple):
+    TTL = 30.0
+    MAX_ENTRIES = 4096
+    # friend lists MutualFriendsEngine keeps; they expire after TTL as well
+    MAX_FRIEND_LISTS = 1024
+    # how often the SQLite backend drops expired and least recently used entries, seconds
+    EVICT_INTERVAL = 5.0
+
+
+class CrawlerSettings(tp.NamedTuple):
+    MAX_DEPTH = 2
+    MAX_IN_FLIGHT = 8
+    CHECKPOINT_INTERVAL = 30.0
+
+
+class ServerSettings(tp.NamedTuple):
+    MAX_CONNECTIONS = 256
+    MAX_CONCURRENT_COMMANDS = 32
+    PIPELINE_DEPTH = 8
+    MAX_LINE_LENGTH = 64 * 1024
+    # on shutdown, connections get this long to receive the replies to the commands they already sent, seconds
+    DRAIN_TIMEOUT = 10.0
+
+
+class PreforkSettings(tp.NamedTuple):
+    WORKERS = os.cpu_count() or 1
+    # a worker that died is restarted after this delay, doubled for every crash in a row up to the maximum
+    RESTART_DELAY = 1.0
+    RESTART_DELAY_MAX = 30.0
+    # a worker that ran at least this long before it died is not counted as crashing in a row, seconds
+    STABLE_UPTIME = 60.0
+    # response cache shared by the workers
+    CACHE_PATH = os.getenv("CACHE_PATH", os.path.join(tempfile.gettempdir(), "vk_parser_cache.sqlite3"))
+
+
+class JobSettings(tp.NamedTuple):
+    # chunks of all jobs run at most this many at a time, so interactive commands keep most of the request capacity
+    WORKERS = 2
+    # ids per chunk: a chunk is the unit of scheduling and of partial results
+    CHUNK_SIZE = 100
+    MAX_JOBS = 1000
+    # finished jobs are kept this long for `status` and `fetch`, seconds
+    RESULT_TTL = 3600.0
+    FETCH_LIMIT = 1000
+
+
+class MetricsSettings(tp.NamedTuple):
+    HOST = "127.0.0.1"
+    PORT = 9091
+    PATH = "/metrics"
+    LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class ExecutorSettings(tp.NamedTuple):
+    PROCESS_WORKERS = os.cpu_count() or 1
+    THREAD_WORKERS = 4
+    # batches with at least this many items are validated in the process pool
+    PROCESS_THRESHOLD = 2000
+
+
+class PhotoSettings(tp.NamedTuple):
+    # photo tags are grouped by the day in this time zone (an IANA name, e.g. "Europe/Moscow");
+    # None is the local time zone, with its daylight saving time taken into account for every timestamp
+    TIMEZONE = zoneinfo.ZoneInfo(os.environ["PHOTO_TIMEZONE"]) if os.getenv("PHOTO_TIMEZONE") else None
+    DAY_FORMAT = "%d-%m-%Y"
+
+
 class DefaultRequestSettings(tp.NamedTuple):
     ALL_FIELDS = "about,activities,occupation,bdate,city,platform,connections,contacts,counters," \
                  "relatives,sex,universities,last_seen"
+    FRIENDS_PAGE_SIZE = 500
+    # the largest `count` photos.getUserPhotos accepts
+    PHOTOS_PAGE_SIZE = 1000
+    PAGES_IN_FLIGHT = 4
+    MUTUAL_TARGETS_LIMIT = 100
 
 
 class FriendsAPI:
 
     @staticmethod
-    def get(id_list, *, fields=DefaultRequestSettings.ALL_FIELDS, count=500):
+    def get(id_list, *, fields=DefaultRequestSettings.ALL_FIELDS, count=DefaultRequestSettings.FRIENDS_PAGE_SIZE,
+            offset=0):
         for user_id in id_list:
-            yield rf"https://api.vk.com/method/friends.get?user_id={user_id}&count={count}&fields={fields}" \
-                  rf"&access_token={API.ACCESS_TOKEN}&v={API.VERSION}"
+            yield FriendsAPI.get_page(user_id, fields=fields, count=count, offset=offset)
+
+    @staticmethod
+    def get_page(user_id, *, fields=DefaultRequestSettings.ALL_FIELDS, count=DefaultRequestSettings.FRIENDS_PAGE_SIZE,
+                 offset=0) -> str:
+        return rf"https://api.vk.com/method/friends.get?user_id={user_id}&count={count}&offset={offset}" \
+               rf"&fields={fields}&access_token={API.ACCESS_TOKEN}&v={API.VERSION}"
 
     @staticmethod
     def get_mutual(target_list: tp.List[tp.Tuple[int, int]], count=500) -> tp.List[str]:
@@ -40,12 +148,83 @@ class FriendsAPI:
             source, target = pair
             yield rf"https://api.vk.com/method/friends.getMutual?source_uid={source}&target_uids={target}&count={count}&access_token={API.ACCESS_TOKEN}&v={API.VERSION}"
 
+    @staticmethod
+    def get_mutual_targets(source: int, targets: tp.List[int], *,
+                           batch_size=DefaultRequestSettings.MUTUAL_TARGETS_LIMIT) -> tp.Generator[str, None, None]:
+        """One friends.getMutual request per up to 100 targets of the same source."""
+        batch_size = min(batch_size, DefaultRequestSettings.MUTUAL_TARGETS_LIMIT)
+        for start in range(0, len(targets), batch_size):
+            target_uids = ",".join(str(target) for target in targets[start:start + batch_size])
+            yield rf"https://api.vk.com/method/friends.getMutual?source_uid={source}&target_uids={target_uids}" \
+                  rf"&access_token={API.ACCESS_TOKEN}&v={API.VERSION}"
 
-class Photos:
+
+class PhotosAPI:
 
     @staticmethod
-    def get_user_photos(*, target_list: tp.List, count: int = 100, extended=0):
+    def get_user_photos(*, target_list: tp.List, count: int = DefaultRequestSettings.PHOTOS_PAGE_SIZE, extended=0):
         for user_id in target_list:
-            yield rf"https://api.vk.com/method/photos.getUserPhotos?user_id={user_id}&count={count}&extended={extended}\
-            &access_token={API.ACCESS_TOKEN}&v={API.VERSION}"
+            yield PhotosAPI.get_page(user_id, count=count, extended=extended)
+
+    @staticmethod
+    def get_page(user_id, *, count: int = DefaultRequestSettings.PHOTOS_PAGE_SIZE, offset: int = 0, extended=0) -> str:
+        """One page of the photos a user is tagged in, newest first."""
+        return rf"https://api.vk.com/method/photos.getUserPhotos?user_id={user_id}&count={count}&offset={offset}" \
+               rf"&extended={extended}&access_token={API.ACCESS_TOKEN}&v={API.VERSION}"
+
+
+Photos = PhotosAPI
+
+
+class ExecuteAPI:
+    """Packs plain API method URLs into `execute` calls, up to 25 calls per request.
+    Repeated long parameter values (e.g. `fields`) are hoisted into VKScript variables
+    to keep the request URL short."""
+    MAX_CALLS = 25
+    SERVICE_PARAMS = ("access_token", "v")
+
+    @staticmethod
+    def parse_method_url(url: str) -> tp.Tuple[str, tp.Dict[str, str], tp.Tuple[str, str]]:
+        """Splits a method URL into the method name, its parameters and the (access_token, version) pair."""
+        split_url = urlsplit(url)
+        method = split_url.path.rsplit("/", 1)[-1]
+        params = dict(parse_qsl(split_url.query))
+        credentials = params.pop("access_token", None), params.pop("v", None)
+        return method, params, credentials
+
+    @staticmethod
+    def form_code(calls: tp.List[tp.Tuple[str, tp.Dict[str, str]]]) -> str:
+        value_count = collections.Counter(value for _, params in calls for value in params.values() if len(value) > 16)
+        variables = {value: f"v{index}" for index, value in
+                     enumerate(value for value, count in value_count.items() if count > 1)}
+        header = "".join(f"var {name}={json.dumps(value, ensure_ascii=False)};" for value, name in variables.items())
+
+        api_calls = []
+        for method, params in calls:
+            arguments = ",".join(f"{json.dumps(key)}:{variables.get(value) or json.dumps(value, ensure_ascii=False)}"
+                                 for key, value in params.items())
+            api_calls.append(f"API.{method}({{{arguments}}})")
+        return f"{header}return [{','.join(api_calls)}];"
+
+    @staticmethod
+    def pack(calls: tp.List[tp.Tuple[str, tp.Dict[str, str]]], *, access_token, version=API.VERSION) -> str:
+        query = urlencode({"code": ExecuteAPI.form_code(calls), "access_token": access_token, "v": version})
+        return f"https://api.vk.com/method/execute?{query}"
+
+    @staticmethod
+    def batch(url_gen: tp.Iterable[str], *, batch_size=MAX_CALLS) -> tp.Generator[tp.Tuple[str, int], None, None]:
+        """Yields pairs of (execute URL, number of packed calls).
+        Calls are packed in their original order; a batch is flushed when it is full
+        or when the access token or API version changes."""
+        batch_size = min(batch_size, ExecuteAPI.MAX_CALLS)
+        calls, credentials = [], None
+        for url in url_gen:
+            method, params, url_credentials = ExecuteAPI.parse_method_url(url)
+            if calls and (len(calls) >= batch_size or url_credentials != credentials):
+                yield ExecuteAPI.pack(calls, access_token=credentials[0], version=credentials[1]), len(calls)
+                calls = []
+            calls.append((method, params))
+            credentials = url_credentials
+        if calls:
+            yield ExecuteAPI.pack(calls, access_token=credentials[0], version=credentials[1]), len(calls)
 
@@ -0,0 +1,176 @@
+import asyncio
+import dataclasses
+import os
+import pickle
+import time
+import typing as tp
+from asyncrequest import PaginatedRequest, RequestScheduler
+from config import FriendsAPI, DefaultRequestSettings, CrawlerSettings, VKErrorCode
+from exceptions import CrawlerStoppedError
+from vk_parser.vk_parser import FriendsParser
+from vk_parser.aggregators import TopKAggregator
+from vk_parser.pydantic_models import Profile
+
+
+@dataclasses.dataclass
+class CrawlState:
+    seeds: tp.List[int]
+    max_depth: int
+    # every discovered user id; a profile reaches the analytics only the first time it is discovered
+    seen: tp.Set[int] = dataclasses.field(default_factory=set)
+    # queued and in-progress users with their depth; they are crawled again after a resume
+    pending: tp.Dict[int, int] = dataclasses.field(default_factory=dict)
+    failed: tp.Dict[int, int] = dataclasses.field(default_factory=dict)
+    crawled: int = 0
+    analytics: tp.List[tp.Any] = dataclasses.field(default_factory=list)
+
+
+class FriendsCrawler:
+    """Breadth-first friends-of-friends crawler.
+
+    Users whose depth is below `max_depth` have their friend lists fetched (seeds have depth 0),
+    at most `max_in_flight` of them at a time. The state, including the analytics objects, is pickled
+    to `checkpoint_path` every `checkpoint_interval` seconds and when the crawl stops, so that a crawl
+    stopped by a crash or an expired token resumes where it stopped.
+
+    Every newly discovered profile is passed to the `update` method of each analytics object
+    (TopKAggregator, GroupingIndex, SurnameIndex...), so results can be read while the crawl goes on.
+    With `trusted` (and `decoder=decode_json`) friend lists go through the fast ingestion path."""
+
+    def __init__(self, seeds: tp.Iterable[int], *, max_depth: int = CrawlerSettings.MAX_DEPTH,
+                 max_in_flight: int = CrawlerSettings.MAX_IN_FLIGHT,
+                 checkpoint_path: tp.Optional[str] = None,
+                 checkpoint_interval: float = CrawlerSettings.CHECKPOINT_INTERVAL,
+                 fields: str = DefaultRequestSettings.ALL_FIELDS,
+                 page_size: int = DefaultRequestSettings.FRIENDS_PAGE_SIZE,
+                 analytics: tp.Optional[tp.List[tp.Any]] = None,
+                 trusted: bool = False,
+                 **request_options):
+        if max_depth < 1:
+            raise ValueError("max_depth must be at least 1.")
+        self.max_in_flight = max_in_flight
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.fields = fields
+        self.page_size = page_size
+        self.trusted = trusted
+        self.request_options = request_options
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self.state = self.load_checkpoint(checkpoint_path)
+        else:
+            self.state = CrawlState(seeds=[int(seed) for seed in seeds], max_depth=max_depth,
+                                    analytics=analytics if analytics is not None else [TopKAggregator()])
+            for seed in self.state.seeds:
+                if seed not in self.state.seen:
+                    self.state.seen.add(seed)
+                    self.state.pending[seed] = 0
+        self._checkpoint_at = time.monotonic()
+
+    @property
+    def analytics(self) -> tp.List[tp.Any]:
+        return self.state.analytics
+
+    @property
+    def finished(self) -> bool:
+        return not self.state.pending
+
+    @staticmethod
+    def load_checkpoint(path: str) -> CrawlState:
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+    def save_checkpoint(self):
+        if not self.checkpoint_path:
+            return
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        with open(temporary_path, "wb") as file:
+            pickle.dump(self.state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.checkpoint_path)
+        self._checkpoint_at = time.monotonic()
+
+    @staticmethod
+    def is_crawlable(profile: Profile) -> bool:
+        return not profile.deactivated and not profile.is_closed
+
+    async def fetch_friends(self, user_id: int) -> tp.Optional[tp.List[Profile]]:
+        """Every page of the friend list; None if VK refused to give it (private profile, etc.)."""
+        request = PaginatedRequest(lambda offset: FriendsAPI.get_page(user_id, fields=self.fields,
+                                                                      count=self.page_size, offset=offset),
+                                   page_size=self.page_size, **self.request_options)
+        profiles = []
+        async for page in request.iter_pages():
+            error_code = RequestScheduler.get_vk_error_code(page)
+            if error_code == VKErrorCode.AUTHORIZATION_FAILED:
+                raise CrawlerStoppedError(f"Authorization failed while crawling {user_id}: {page['error']}")
+            if error_code is not None:
+                self.state.failed[user_id] = error_code
+                return None
+            # the pages are fetched for this call only, so their raw items can go as soon as they are parsed
+            profiles.extend(FriendsParser.iter_items(page, trusted=self.trusted, consume=True))
+        return profiles
+
+    def _discover(self, depth: int, profile_list: tp.List[Profile], queue: asyncio.Queue) -> tp.List[Profile]:
+        state = self.state
+        new_profiles = []
+        for profile in profile_list:
+            if profile.id in state.seen:
+                continue
+            new_profiles.append(profile)
+            state.seen.add(profile.id)
+            if depth + 1 < state.max_depth and self.is_crawlable(profile):
+                state.pending[profile.id] = depth + 1
+                queue.put_nowait((profile.id, depth + 1))
+        for analytics in state.analytics:
+            analytics.update(new_profiles)
+        return new_profiles
+
+    async def _worker(self, queue: asyncio.Queue, output: asyncio.Queue):
+        while True:
+            user_id, depth = await queue.get()
+            try:
+                profile_list = await self.fetch_friends(user_id)
+                new_profiles = self._discover(depth, profile_list, queue) if profile_list is not None else []
+                del self.state.pending[user_id]
+                self.state.crawled += 1
+                await output.put((user_id, depth, new_profiles))
+            except Exception as exception:
+                await output.put(exception)
+            finally:
+                queue.task_done()
+
+    async def iter_crawl(self) -> tp.AsyncGenerator[tp.Tuple[int, int, tp.List[Profile]], None]:
+        """Yields (user id, depth, newly discovered friends) for every crawled user."""
+        queue: asyncio.Queue = asyncio.Queue()
+        output: asyncio.Queue = asyncio.Queue(maxsize=2 * self.max_in_flight)
+        # shallow users go first, as in a plain breadth-first search
+        for user_id, depth in sorted(self.state.pending.items(), key=lambda item: item[1]):
+            queue.put_nowait((user_id, depth))
+
+        async def finish():
+            await queue.join()
+            await output.put(None)
+
+        tasks = [asyncio.ensure_future(self._worker(queue, output)) for _ in range(self.max_in_flight)]
+        tasks.append(asyncio.ensure_future(finish()))
+        try:
+            while True:
+                item = await output.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                if time.monotonic() - self._checkpoint_at >= self.checkpoint_interval:
+                    self.save_checkpoint()
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.save_checkpoint()
+
+    async def run(self) -> tp.List[tp.Any]:
+        """Crawls until the frontier is empty and returns the analytics objects."""
+        async for _ in self.iter_crawl():
+            pass
+        return self.analytics
@@ -2,7 +2,8 @@ from pydantic import ValidationError
 
 __all__ = ["BadJSONError", "EmptyCommandError",
            "IncorrectCommandError", "ValidationError",
-           "CommandNotFoundError"]
+           "CommandNotFoundError", "CrawlerStoppedError",
+           "JobNotFoundError", "JobQueueFullError"]
 
 
 class BadJSONError(Exception):
@@ -18,4 +19,16 @@ class IncorrectCommandError(Exception):
 
 
 class CommandNotFoundError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class CrawlerStoppedError(Exception):
+    pass
+
+
+class JobNotFoundError(Exception):
+    pass
+
+
+class JobQueueFullError(Exception):
+    pass
@@ -0,0 +1,115 @@
+import asyncio
+import concurrent.futures
+import functools
+import typing as tp
+from config import ExecutorSettings
+from metrics import STAGE_SECONDS
+
+
+class FriendsSummary(tp.NamedTuple):
+    """Picklable result of summarize_friends: plain ids, strings and counts instead of pydantic models."""
+    profile_count: int
+    groups: tp.Dict[str, tp.Tuple[tp.Tuple[tp.Any, tp.Tuple[int, ...]], ...]]
+    universities: tp.Tuple[tp.Tuple[tp.Tuple[str, ...], int], ...]
+    city: tp.Optional[str]
+
+
+def count_items(response_list: tp.Iterable[dict]) -> int:
+    count = 0
+    for json_ in response_list:
+        body = json_.get("response") if isinstance(json_, dict) else None
+        if isinstance(body, dict) and isinstance(body.get("items"), list):
+            count += len(body["items"])
+    return count
+
+
+def summarize_friends(response_list: tp.List[dict], *, group_fields: tp.Iterable[str] = ("city",),
+                      top_count: int = 3) -> FriendsSummary:
+    """Validates raw friends.get replies and runs the grouping/top-N analytics over them.
+    Runs in a worker, so vk_parser is imported there and nothing but the summary travels back.
+    The replies are only read: in the thread pool they are the ones of the response cache.
+    Profiles are validated against the slim model of the analytics asked for (see plan_query)."""
+    from vk_parser.vk_parser import GroupingIndex
+    from vk_parser.aggregators import TopKAggregator
+    from vk_parser.query_plan import plan_query, SUMMARY_ANALYTICS
+
+    parser = plan_query(*SUMMARY_ANALYTICS, *group_fields).parser
+    index, aggregator = GroupingIndex(), TopKAggregator()
+    for json_ in response_list:
+        profile_list = list(parser.iter_items(json_))
+        index.update(profile_list)
+        aggregator.update(profile_list)
+
+    groups = {field: tuple((key, tuple(profile.id for profile in profiles))
+                           for key, profiles in index.groups(field))
+              for field in group_fields}
+    universities = tuple((tuple(sorted(names)), count)
+                         for names, count in aggregator.get_most_frequent_university(top_count=top_count))
+    return FriendsSummary(aggregator.profile_count, groups, universities, aggregator.get_most_frequent_city())
+
+
+def summarize_friend_lists(response_list: tp.List[dict], **options) -> tp.List[tp.Optional[FriendsSummary]]:
+    """summarize_friends of every friend list on its own; None for a reply that carries no friend list."""
+    return [summarize_friends([json_], **options)
+            if isinstance(json_, dict) and isinstance(json_.get("response"), dict) else None
+            for json_ in response_list]
+
+
+def run_with_stage_seconds(func: tp.Callable, *args, **kwargs):
+    """Calls func in a worker process and returns its result with the stage timings it recorded there,
+    which would otherwise stay in the registry of that process."""
+    # a forked worker starts with a copy of the observations of the parent
+    STAGE_SECONDS.take()
+    result = func(*args, **kwargs)
+    return result, STAGE_SECONDS.take()
+
+
+class AnalyticsExecutor:
+    """Runs CPU-heavy parsing and analytics off the event loop: batches of at least `process_threshold`
+    items go to a process pool, smaller ones to a thread pool where the pickling overhead is not worth it.
+    The pools are created on first use."""
+
+    def __init__(self, *, process_workers: int = ExecutorSettings.PROCESS_WORKERS,
+                 thread_workers: int = ExecutorSettings.THREAD_WORKERS,
+                 process_threshold: int = ExecutorSettings.PROCESS_THRESHOLD):
+        self.process_workers = process_workers
+        self.thread_workers = thread_workers
+        self.process_threshold = process_threshold
+        self._process_pool: tp.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self._thread_pool: tp.Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    @property
+    def process_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.process_workers)
+        return self._process_pool
+
+    @property
+    def thread_pool(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_workers,
+                                                                      thread_name_prefix="analytics")
+        return self._thread_pool
+
+    def choose(self, item_count: int) -> concurrent.futures.Executor:
+        if self.process_workers > 0 and item_count >= self.process_threshold:
+            return self.process_pool
+        return self.thread_pool
+
+    async def run(self, func: tp.Callable, response_list: tp.List[dict], *args, **kwargs):
+        """Calls func(response_list, *args, **kwargs) in the pool that suits the size of the batch."""
+        executor = self.choose(count_items(response_list))
+        loop = asyncio.get_running_loop()
+        if executor is not self._process_pool:
+            # threads record their timings in this process already
+            return await loop.run_in_executor(executor, functools.partial(func, response_list, *args, **kwargs))
+        result, stage_seconds = await loop.run_in_executor(
+            executor, functools.partial(run_with_stage_seconds, func, response_list, *args, **kwargs))
+        STAGE_SECONDS.merge(stage_seconds)
+        return result
+
+    def shutdown(self, wait: bool = True):
+        for pool in (self._process_pool, self._thread_pool):
+            if pool is not None:
+                pool.shutdown(wait=wait)
+        self._process_pool = self._thread_pool = None
@@ -0,0 +1,189 @@
+import asyncio
+import itertools
+import logging
+import time
+import typing as tp
+import uuid
+from config import JobSettings
+from exceptions import JobNotFoundError, JobQueueFullError
+from metrics import JOBS, JOB_CHUNKS_QUEUED
+
+logger = logging.getLogger(__name__)
+
+ChunkRunner = tp.Callable[[tp.List[str]], tp.Awaitable[tp.List[tp.Any]]]
+
+
+class JobStatus(tp.NamedTuple):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+
+
+class JobPriority(tp.NamedTuple):
+    # jobs that fit into a single chunk
+    HIGH = 0
+    NORMAL = 1
+
+
+class Job:
+    """A bulk command split into chunks of ids. Every chunk has one result per id;
+    a chunk that failed as a whole gets an error for each of its ids."""
+
+    def __init__(self, job_id: str, kind: str, items: tp.List[str], *, chunk_size: int = JobSettings.CHUNK_SIZE):
+        self.id = job_id
+        self.kind = kind
+        self.items = items
+        self.chunk_size = chunk_size
+        self.chunk_count = (len(items) + chunk_size - 1) // chunk_size
+        self.priority = JobPriority.HIGH if self.chunk_count <= 1 else JobPriority.NORMAL
+        self.results: tp.List[tp.Optional[tp.List[tp.Any]]] = [None] * self.chunk_count
+        self.done_chunks = 0
+        self.running_chunks = 0
+        self.created_at = time.time()
+        self.finished_at: tp.Optional[float] = None
+
+    def chunk(self, index: int) -> tp.List[str]:
+        return self.items[index * self.chunk_size:(index + 1) * self.chunk_size]
+
+    @property
+    def status(self) -> str:
+        if self.done_chunks == self.chunk_count:
+            return JobStatus.DONE
+        if self.done_chunks or self.running_chunks:
+            return JobStatus.RUNNING
+        return JobStatus.QUEUED
+
+    def complete_chunk(self, index: int, results: tp.List[tp.Any]):
+        self.results[index] = results
+        self.done_chunks += 1
+        if self.done_chunks == self.chunk_count:
+            self.finished_at = time.time()
+
+    @property
+    def ready_count(self) -> int:
+        """Ids whose results are ready without a gap before them: partial results are returned in order."""
+        count = 0
+        for results in self.results:
+            if results is None:
+                break
+            count += len(results)
+        return count
+
+    def status_json(self) -> dict:
+        return {"job_id": self.id, "kind": self.kind, "status": self.status, "items": len(self.items),
+                "chunks": self.chunk_count, "done_chunks": self.done_chunks, "ready": self.ready_count,
+                "created_at": self.created_at, "finished_at": self.finished_at}
+
+    def fetch_json(self, offset: int = 0, limit: int = JobSettings.FETCH_LIMIT) -> dict:
+        """Results of the ids [offset, offset + limit) that are ready; `next_offset` is where to continue."""
+        end = min(self.ready_count, offset + limit)
+        results = []
+        for index in range(offset // self.chunk_size, (end + self.chunk_size - 1) // self.chunk_size):
+            start = index * self.chunk_size
+            results.extend(self.results[index][max(offset - start, 0):end - start])
+        return {"job_id": self.id, "status": self.status, "items": len(self.items), "offset": offset,
+                "next_offset": max(offset, end), "complete": end == len(self.items), "results": results}
+
+
+class JobManager:
+    """Runs bulk commands in the background. Chunks of every job go into one priority queue shared by
+    all connections and are run by `workers` tasks: single-chunk jobs first, then chunks in round-robin
+    over the jobs (the first chunk of every job, then the second...), so a big job does not hold back
+    the ones submitted after it. `runners` map a job kind to the coroutine that runs one chunk."""
+
+    def __init__(self, runners: tp.Dict[str, ChunkRunner], *, workers: int = JobSettings.WORKERS,
+                 chunk_size: int = JobSettings.CHUNK_SIZE, max_jobs: int = JobSettings.MAX_JOBS,
+                 result_ttl: float = JobSettings.RESULT_TTL):
+        self.runners = runners
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_jobs = max_jobs
+        self.result_ttl = result_ttl
+        self.jobs: tp.Dict[str, Job] = {}
+        self._sequence = itertools.count()
+        self._loop = None
+        self._queue: tp.Optional[asyncio.PriorityQueue] = None
+        self._worker_tasks: tp.List[asyncio.Task] = []
+
+    def _bind_loop(self):
+        # the queue and the workers belong to the loop they were created in
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._queue = asyncio.PriorityQueue()
+            self._worker_tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+            JOB_CHUNKS_QUEUED.set(0)
+        else:
+            # a worker that has stopped (see _work) is replaced
+            self._worker_tasks = [asyncio.ensure_future(self._work()) if task.done() else task
+                                  for task in self._worker_tasks]
+
+    def _evict(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self.result_ttl:
+                del self.jobs[job_id]
+        if len(self.jobs) >= self.max_jobs:
+            finished = sorted((job for job in self.jobs.values() if job.finished_at is not None),
+                              key=lambda job: job.finished_at)
+            for job in finished[:len(self.jobs) - self.max_jobs + 1]:
+                del self.jobs[job.id]
+
+    def submit(self, kind: str, items: tp.List[str]) -> Job:
+        if kind not in self.runners:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if not items:
+            raise ValueError("Empty job.")
+        self._bind_loop()
+        self._evict()
+        if len(self.jobs) >= self.max_jobs:
+            raise JobQueueFullError(f"{self.max_jobs} jobs are already queued or running.")
+        job = Job(uuid.uuid4().hex[:16], kind, items, chunk_size=self.chunk_size)
+        self.jobs[job.id] = job
+        sequence = next(self._sequence)
+        for index in range(job.chunk_count):
+            self._queue.put_nowait((job.priority, index, sequence, job.id))
+        JOB_CHUNKS_QUEUED.inc(job.chunk_count)
+        JOBS.inc(status=JobStatus.QUEUED)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise JobNotFoundError(job_id)
+        return job
+
+    async def _work(self):
+        while True:
+            _, index, _, job_id = await self._queue.get()
+            JOB_CHUNKS_QUEUED.dec()
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            chunk = job.chunk(index)
+            job.running_chunks += 1
+            try:
+                results = await self.runners[job.kind](chunk)
+            except asyncio.CancelledError as exception:
+                # only the cancellation of the worker itself stops it; a runner can also raise CancelledError,
+                # e.g. from a request it awaited being cancelled. Task.cancelling() is there since Python 3.11
+                cancelling = getattr(asyncio.current_task(), "cancelling", None)
+                if cancelling is None or cancelling():
+                    raise
+                logger.warning("Chunk %s of job %s was cancelled.", index, job_id)
+                results = [{"error": {"error_code": 0, "error_msg": f"Chunk failed: {exception!r}"}}] * len(chunk)
+            except Exception as exception:
+                logger.exception("Chunk %s of job %s failed.", index, job_id)
+                results = [{"error": {"error_code": 0, "error_msg": f"Chunk failed: {exception!r}"}}] * len(chunk)
+            finally:
+                job.running_chunks -= 1
+            job.complete_chunk(index, results)
+            if job.status == JobStatus.DONE:
+                JOBS.inc(status=JobStatus.DONE)
+
+    async def close(self):
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._loop = None
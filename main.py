@@ -1,19 +1,30 @@
 from vk_parser import vk_parser
-from asyncrequest import AsyncRequest
+from vk_parser.profile_store import ProfileStore
+from asyncrequest import BatchedAsyncRequest
 from config import Photos, FriendsAPI
+from network_settings import session_manager
 import asyncio
 
 
 # 672706393, 350850226,
 async def run_main():
-   request = AsyncRequest(FriendsAPI.get([295465044, 203663240, 551662769]))
-   result = await request.run()
-
-   for res in result:
-      print(res)
-
-   b = vk_parser.FriendsParser(result)
-   print(b.parse())
+   seed_ids = [295465044, 203663240, 551662769]
+   async with session_manager:
+      request = BatchedAsyncRequest(FriendsAPI.get(seed_ids))
+      result = await request.run()
+
+   # friends shared by the seeds are parsed and counted once
+   store = ProfileStore()
+   store.add_responses(seed_ids, result)
+   print(store.stats())
+   for seed_id in store.seeds:
+      print(seed_id, len(store.friend_ids(seed_id)))
+
+   for group, items in vk_parser.GroupingIndex(store.profiles()).groups(vk_parser.GroupingField.CITY):
+      print(group)
+      for i in items:
+         print(i)
+      print()
    #a = vk_parser.PhotoParser(result)
    #print(a.parse())
 
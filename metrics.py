@@ -0,0 +1,225 @@
+import abc
+import bisect
+import contextlib
+import threading
+import time
+import typing as tp
+from config import MetricsSettings
+
+LabelValues = tp.Tuple[str, ...]
+
+
+class Metric(abc.ABC):
+    """A named family of values, one per combination of label values."""
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: tp.Dict[str, tp.Any]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @staticmethod
+    def format_labels(labelnames: tp.Sequence[str], values: tp.Sequence[str]) -> str:
+        if not labelnames:
+            return ""
+        pairs = ",".join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+        return f"{{{pairs}}}"
+
+    @abc.abstractmethod
+    def samples(self) -> tp.Iterator[tp.Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def snapshot(self) -> tp.Dict[str, tp.Any]:
+        raise NotImplementedError
+
+    @staticmethod
+    def format_value(value: float) -> str:
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+    def render(self) -> tp.List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(f"{name}{labels} {self.format_value(value)}" for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        # a metric without labels is reported from the start, not after its first change
+        self._values: tp.Dict[LabelValues, float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield self.name, self.format_labels(self.labelnames, key), value
+
+    def snapshot(self):
+        return {",".join(key) or "total": value for key, value in sorted(self._values.items())}
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextlib.contextmanager
+    def track(self, **labels):
+        """Counts the block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram, as Prometheus expects it; `buckets` are upper bounds in seconds."""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (), *,
+                 buckets: tp.Sequence[float] = MetricsSettings.LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: [count in every bucket (not cumulative) + overflow, sum]
+        self._values: tp.Dict[LabelValues, tp.List[tp.Any]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def take(self) -> tp.Dict[LabelValues, tp.List[tp.Any]]:
+        """Removes and returns the observations made so far, e.g. in a worker process (see `merge`)."""
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values: tp.Dict[LabelValues, tp.List[tp.Any]]):
+        """Adds observations taken from a histogram with the same buckets."""
+        with self._lock:
+            for key, (counts, total) in values.items():
+                state = self._values.get(key)
+                if state is None:
+                    state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+                state[0] = [count + other for count, other in zip(state[0], counts)]
+                state[1] += total
+
+    def samples(self):
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                bucket_labels = self.format_labels((*self.labelnames, "le"),
+                                                   (*key, "+Inf" if bound == float("inf") else f"{bound:g}"))
+                yield f"{self.name}_bucket", bucket_labels, cumulative
+            labels = self.format_labels(self.labelnames, key)
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+    def snapshot(self):
+        result = {}
+        for key, (counts, total) in sorted(self._values.items()):
+            count = sum(counts)
+            result[",".join(key) or "total"] = {"count": count, "sum": round(total, 6),
+                                                "mean": round(total / count, 6) if count else 0.0}
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: tp.Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tp.Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tp.Sequence[str] = (), **options) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, **options))
+
+    def snapshot(self) -> tp.Dict[str, tp.Any]:
+        """Every metric as plain dicts, for the `stats` command."""
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+UPSTREAM_SECONDS = registry.histogram("vk_upstream_request_seconds",
+                                      "Time of a single HTTP request to VK API.", ("method",))
+STAGE_SECONDS = registry.histogram("vk_stage_seconds",
+                                   "Time spent in a processing stage (decode, validation, transform, grouping, "
+                                   "analytics).", ("stage",))
+VK_ERRORS = registry.counter("vk_api_errors_total", "Errors returned by VK API, by error code.", ("code",))
+VK_RETRIES = registry.counter("vk_api_retries_total", "Requests retried after a VK API error.", ("code",))
+TOKEN_FAILOVERS = registry.counter("vk_token_failovers_total",
+                                   "Requests moved to another access token after a VK API error.", ("code",))
+REQUESTS_IN_FLIGHT = registry.gauge("vk_requests_in_flight", "HTTP requests to VK API waiting for a reply.")
+COMMANDS = registry.counter("server_commands_total", "Commands handled by the server.", ("command",))
+COMMAND_SECONDS = registry.histogram("server_command_seconds", "Time to execute a command.", ("command",))
+COMMANDS_IN_FLIGHT = registry.gauge("server_commands_in_flight", "Commands being executed.")
+JOBS = registry.counter("server_jobs_total", "Background jobs, by the status they reached.", ("status",))
+JOB_CHUNKS_QUEUED = registry.gauge("server_job_chunks_queued", "Chunks of background jobs waiting for a worker.")
+CONNECTIONS = registry.gauge("server_connections", "Open client connections.")
+
+
+async def serve_prometheus(*, host: str = MetricsSettings.HOST, port: int = MetricsSettings.PORT,
+                           metrics: MetricsRegistry = registry):
+    """Starts the HTTP endpoint that serves the registry in the Prometheus text format at /metrics.
+    Returns the aiohttp runner; stop the endpoint with `await runner.cleanup()`."""
+    from aiohttp import web
+
+    async def handle(_request):
+        return web.Response(body=metrics.render_prometheus().encode(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get(MetricsSettings.PATH, handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,2 +1,68 @@
+import asyncio
+import typing as tp
+import aiohttp
 
 
+class ConnectionSettings(tp.NamedTuple):
+    LIMIT = 100
+    LIMIT_PER_HOST = 20
+    KEEPALIVE_TIMEOUT = 60.0
+    DNS_CACHE_TTL = 300
+    TOTAL_TIMEOUT = 30.0
+
+
+class SessionManager:
+    """Owns one aiohttp.ClientSession shared by the whole process, so that connections to
+    api.vk.com are kept alive and reused between requests instead of repeating DNS lookup and TLS handshake.
+    The session is created lazily in the running event loop and must be closed with `close()`."""
+
+    def __init__(self, *, limit: int = ConnectionSettings.LIMIT,
+                 limit_per_host: int = ConnectionSettings.LIMIT_PER_HOST,
+                 keepalive_timeout: float = ConnectionSettings.KEEPALIVE_TIMEOUT,
+                 dns_cache_ttl: int = ConnectionSettings.DNS_CACHE_TTL,
+                 total_timeout: float = ConnectionSettings.TOTAL_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.total_timeout = total_timeout
+        self._session: tp.Optional[aiohttp.ClientSession] = None
+        self._loop = None
+
+    def configure(self, **settings):
+        """Changes connection settings; they are applied to the next session that is created."""
+        for name, value in settings.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise AttributeError(f"Unknown connection setting: {name}")
+            setattr(self, name, value)
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(limit=self.limit,
+                                         limit_per_host=self.limit_per_host,
+                                         keepalive_timeout=self.keepalive_timeout,
+                                         ttl_dns_cache=self.dns_cache_ttl,
+                                         use_dns_cache=True)
+        return aiohttp.ClientSession(connector=connector,
+                                     timeout=aiohttp.ClientTimeout(total=self.total_timeout))
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._session = self._create_session()
+            self._loop = loop
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+session_manager = SessionManager()
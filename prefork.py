@@ -0,0 +1,180 @@
+"""Pre-fork mode: several AsyncServer processes listening on the same port.
+
+    python -m prefork --host 0.0.0.0 --port 9090 --workers 4
+
+Every worker binds its own socket with SO_REUSEPORT, so the kernel spreads incoming connections
+over the workers and the CPU-heavy parsing of one worker does not hold back the others. The workers
+share the response cache through SQLite (PreforkSettings.CACHE_PATH), so a reply fetched by one of them
+is a cache hit for all. The supervisor restarts a worker that died; on SIGTERM or SIGINT it asks every
+worker to drain (see AsyncServer.shutdown) and waits for them to exit.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
+import typing as tp
+from config import ServerSettings, PreforkSettings
+
+logger = logging.getLogger("prefork")
+
+
+def run_worker(index: int, host: str, port: int, cache_path: tp.Optional[str], drain_timeout: float,
+               metrics_port: tp.Optional[int], server_settings: tp.Dict[str, tp.Any]):
+    """Entry point of a worker process."""
+    # imported in the worker: the parent process only supervises
+    from asyncserver import AsyncServer, ClientAddress
+    from response_cache import SQLiteCacheBackend
+    import service_functions
+
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s %(name)s: %(message)s")
+    if cache_path:
+        service_functions.command_cache.backend = SQLiteCacheBackend(cache_path)
+    # every worker has its own metrics, so each one serves them on its own port
+    metrics_address = ClientAddress(ip=host, port=metrics_port + index) if metrics_port is not None else None
+    server = AsyncServer.bind(ip=host, port=port, reuse_port=True, metrics_address=metrics_address,
+                              **server_settings)
+    try:
+        asyncio.run(serve_until_signal(server, drain_timeout=drain_timeout))
+    finally:
+        if cache_path:
+            # commits the cache writes still queued
+            service_functions.command_cache.backend.close()
+
+
+async def serve_until_signal(server, *, drain_timeout: float = ServerSettings.DRAIN_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stop.set)
+    serve_task = asyncio.ensure_future(server.serve())
+    stop_task = asyncio.ensure_future(stop.wait())
+    await asyncio.wait({serve_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+    if serve_task.done():
+        stop_task.cancel()
+        # the server failed, e.g. it could not bind: the supervisor sees the exit code
+        serve_task.result()
+        return
+    logger.info("Draining connections.")
+    await server.shutdown(timeout=drain_timeout)
+    # serve() returns once it has released its resources after the drain
+    await asyncio.gather(serve_task, return_exceptions=True)
+
+
+class WorkerSlot:
+    """One worker position of the supervisor and its restart history."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.process: tp.Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.crashes = 0
+        self.restart_at: tp.Optional[float] = None
+
+
+class PreforkServer:
+    """Supervisor of `workers` AsyncServer processes sharing one port."""
+
+    def __init__(self, *, host: str, port: int, workers: int = PreforkSettings.WORKERS,
+                 cache_path: tp.Optional[str] = PreforkSettings.CACHE_PATH,
+                 drain_timeout: float = ServerSettings.DRAIN_TIMEOUT,
+                 restart_delay: float = PreforkSettings.RESTART_DELAY,
+                 restart_delay_max: float = PreforkSettings.RESTART_DELAY_MAX,
+                 stable_uptime: float = PreforkSettings.STABLE_UPTIME,
+                 metrics_port: tp.Optional[int] = None, **server_settings):
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise OSError("SO_REUSEPORT is not supported on this platform, run a single AsyncServer instead.")
+        self.host = host
+        self.port = port
+        self.cache_path = cache_path
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        self.restart_delay_max = restart_delay_max
+        self.stable_uptime = stable_uptime
+        self.metrics_port = metrics_port
+        self.server_settings = server_settings
+        self.slots = [WorkerSlot(index) for index in range(workers)]
+        self._stopping = False
+        self._context = multiprocessing.get_context("spawn")
+
+    def start_worker(self, slot: WorkerSlot):
+        slot.process = self._context.Process(
+            target=run_worker, name=f"vk-server-worker-{slot.index}",
+            args=(slot.index, self.host, self.port, self.cache_path, self.drain_timeout, self.metrics_port,
+                  self.server_settings))
+        slot.process.start()
+        slot.started_at = time.monotonic()
+        slot.restart_at = None
+        logger.info("Started worker %s, pid %s.", slot.index, slot.process.pid)
+
+    def schedule_restart(self, slot: WorkerSlot):
+        uptime = time.monotonic() - slot.started_at
+        slot.crashes = 0 if uptime >= self.stable_uptime else slot.crashes + 1
+        delay = min(self.restart_delay_max, self.restart_delay * 2 ** max(slot.crashes - 1, 0))
+        slot.restart_at = time.monotonic() + delay
+        logger.warning("Worker %s (pid %s) exited with code %s after %.1fs, restarting in %.1fs.",
+                       slot.index, slot.process.pid, slot.process.exitcode, uptime, delay)
+        slot.process = None
+
+    def stop(self, *_):
+        self._stopping = True
+
+    def run(self):
+        """Starts the workers and supervises them until SIGTERM or SIGINT."""
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signal_number, self.stop)
+        if self.cache_path:
+            # creates the database and switches it to WAL once, before the workers race to do it
+            from response_cache import SQLiteCacheBackend
+            SQLiteCacheBackend(self.cache_path).close()
+        for slot in self.slots:
+            self.start_worker(slot)
+        try:
+            while not self._stopping:
+                sentinels = [slot.process.sentinel for slot in self.slots if slot.process is not None]
+                multiprocessing.connection.wait(sentinels, timeout=0.5)
+                now = time.monotonic()
+                for slot in self.slots:
+                    if slot.process is not None and not slot.process.is_alive() and not self._stopping:
+                        slot.process.join()
+                        self.schedule_restart(slot)
+                    elif slot.process is None and slot.restart_at is not None and now >= slot.restart_at:
+                        self.start_worker(slot)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        processes = [slot.process for slot in self.slots if slot.process is not None and slot.process.is_alive()]
+        for process in processes:
+            os.kill(process.pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.drain_timeout + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("Worker pid %s did not drain in time, killing it.", process.pid)
+                process.kill()
+                process.join()
+        logger.info("All workers stopped.")
+
+
+def main(argv: tp.Optional[tp.List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m prefork", description="Runs AsyncServer in several processes.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=9090)
+    parser.add_argument("--workers", type=int, default=PreforkSettings.WORKERS)
+    parser.add_argument("--cache-path", default=PreforkSettings.CACHE_PATH,
+                        help="SQLite file of the shared response cache, empty for a cache per worker")
+    parser.add_argument("--drain-timeout", type=float, default=ServerSettings.DRAIN_TIMEOUT)
+    parser.add_argument("--metrics-port", type=int, help="worker i serves Prometheus metrics on this port + i")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[supervisor] %(levelname)s %(name)s: %(message)s")
+    PreforkServer(host=args.host, port=args.port, workers=args.workers, cache_path=args.cache_path or None,
+                  drain_timeout=args.drain_timeout, metrics_port=args.metrics_port).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,14 @@
 
 class StaticResponse:
 
+    @staticmethod
+    def server_busy():
+        return "[-] Server is busy, try again later."
+
+    @staticmethod
+    def line_too_long(limit):
+        return f"[-] Command is longer than {limit} bytes."
+
     @staticmethod
     def greetings(ip_address):
         return f"Hi, {ip_address}. This is simple asynchronous server. Type 'help' to know what this server can do."
@@ -9,4 +17,10 @@ class StaticResponse:
     def help(*args, **kwargs):
         return f"\n---------------------------------\n~ 'echo' -\t command enables echo mode: server sends back your message" \
                f'\n~ "friends <VK id or username>" -\t returns a list of VK friends of a particular id' \
-               f"\n~ 'ismutual <id1> <id2>' -\t returns a list of mutual friends between two users\n"
\ No newline at end of file
+               f"\n~ 'ismutual <id1> <id2>' -\t returns a list of mutual friends between two users" \
+               f"\n~ 'stats' -\t returns the server metrics: stage timings, VK API errors and retries, requests in flight" \
+               f" and the state of every access token" \
+               f"\n~ 'submit friends <id> <id> ...' or 'submit ismutual (<id1>,<id2>) ...' -\t starts a background job" \
+               f" over any number of ids and returns its job id" \
+               f"\n~ 'status <job id>' -\t returns the progress of a job" \
+               f"\n~ 'fetch <job id> [offset]' -\t returns the results of a job that are ready, starting from offset\n"
\ No newline at end of file
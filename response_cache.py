@@ -0,0 +1,265 @@
+import asyncio
+import collections
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import typing as tp
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from config import CacheSettings
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(url: str) -> str:
+    """API method plus its parameters in a stable order, without the access token."""
+    split_url = urlsplit(url)
+    params = sorted((key, value) for key, value in parse_qsl(split_url.query) if key != "access_token")
+    return f"{split_url.path.rsplit('/', 1)[-1]}?{urlencode(params)}"
+
+
+def is_cacheable(json_) -> bool:
+    return isinstance(json_, dict) and "response" in json_ and "error" not in json_
+
+
+class MemoryCacheBackend:
+    """LRU-bounded in-memory storage with per-entry expiration time."""
+
+    def __init__(self, *, max_entries: int = CacheSettings.MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: tp.OrderedDict[str, tp.Tuple[float, dict]] = collections.OrderedDict()
+
+    def get(self, key: str) -> tp.Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: dict, *, ttl: float):
+        self._entries[key] = (time.time() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """On-disk storage: survives restarts and can be shared by several processes.
+
+    Only reads run in the calling thread; in WAL mode they do not wait for the writers of other processes.
+    Writes (new entries, access times of hits) go to a writer thread with its own connection, which commits
+    them in batches and evicts expired and least recently used entries every `evict_interval` seconds,
+    so a contended database never blocks the event loop. Entries not written yet are served from memory."""
+
+    def __init__(self, path: str, *, max_entries: int = CacheSettings.MAX_ENTRIES,
+                 evict_interval: float = CacheSettings.EVICT_INTERVAL):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self._connection = self.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                 "(key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._pending: tp.Dict[str, tp.Tuple[float, dict]] = {}
+        self._pending_lock = threading.Lock()
+        self._writes: queue.Queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="sqlite-cache-writer", daemon=True)
+        self._writer.start()
+
+    @staticmethod
+    def connect(path: str) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def get(self, key: str) -> tp.Optional[dict]:
+        now = time.time()
+        with self._pending_lock:
+            entry = self._pending.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            return value if expires_at >= now else None
+        row = self._connection.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at < now:
+            # dropped by the next eviction
+            return None
+        self._writes.put(("touch", key, now))
+        return json.loads(value)
+
+    def set(self, key: str, value: dict, *, ttl: float):
+        now = time.time()
+        with self._pending_lock:
+            self._pending[key] = (now + ttl, value)
+        self._writes.put(("set", key, value, now + ttl, now))
+
+    def _write_loop(self):
+        connection = self.connect(self.path)
+        evicted_at = time.monotonic()
+        try:
+            while True:
+                try:
+                    operations = [self._writes.get(timeout=self.evict_interval)]
+                except queue.Empty:
+                    operations = []
+                while True:
+                    try:
+                        operations.append(self._writes.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in operations
+                try:
+                    self._write(connection, [operation for operation in operations if operation is not None])
+                    if stop or time.monotonic() - evicted_at >= self.evict_interval:
+                        self._evict(connection)
+                        evicted_at = time.monotonic()
+                except sqlite3.Error:
+                    # e.g. the database stayed locked by another process: these writes are lost, the cache goes on
+                    logger.exception("Cache writes to %s failed.", self.path)
+                for _ in operations:
+                    self._writes.task_done()
+                if stop:
+                    break
+        finally:
+            connection.close()
+
+    def _write(self, connection: sqlite3.Connection, operations: tp.List[tuple]):
+        if not operations:
+            return
+        try:
+            with connection:
+                connection.execute("BEGIN")
+                for operation in operations:
+                    kind, key = operation[:2]
+                    if kind == "set":
+                        _, _, value, expires_at, accessed_at = operation
+                        connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                                           (key, json.dumps(value, ensure_ascii=False), expires_at, accessed_at))
+                    elif kind == "touch":
+                        connection.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (operation[2], key))
+                    elif kind == "clear":
+                        connection.execute("DELETE FROM cache")
+        finally:
+            with self._pending_lock:
+                for operation in operations:
+                    if operation[0] != "set":
+                        continue
+                    # a newer value may have been set meanwhile, it stays pending
+                    entry = self._pending.get(operation[1])
+                    if entry is not None and entry[1] is operation[2]:
+                        del self._pending[operation[1]]
+
+    def _evict(self, connection: sqlite3.Connection):
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+            connection.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC "
+                               "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def flush(self):
+        """Waits until every write so far is committed."""
+        self._writes.join()
+
+    def clear(self):
+        with self._pending_lock:
+            self._pending.clear()
+        self._writes.put(("clear", None))
+        self.flush()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._writes.put(None)
+            self._writer.join()
+        self._connection.close()
+
+    def __len__(self):
+        self.flush()
+        return self._connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class ResponseCache:
+    """Caches successful API responses for `ttl` seconds and coalesces concurrent requests:
+    while a key is being fetched, every other request for it waits for the same upstream call."""
+
+    def __init__(self, backend=None, *, ttl: float = CacheSettings.TTL):
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.ttl = ttl
+        self._in_flight: tp.Dict[str, asyncio.Future] = {}
+
+    def get(self, url: str) -> tp.Optional[dict]:
+        return self.backend.get(make_cache_key(url))
+
+    def get_in_flight(self, url: str) -> tp.Optional[asyncio.Future]:
+        return self._in_flight.get(make_cache_key(url))
+
+    def begin(self, url: str) -> asyncio.Future:
+        """Marks the url as being fetched; the caller must finish it with `complete` or `fail`."""
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[make_cache_key(url)] = future
+        return future
+
+    def complete(self, url: str, json_):
+        key = make_cache_key(url)
+        if is_cacheable(json_):
+            self.backend.set(key, json_, ttl=self.ttl)
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(json_)
+
+    def fail(self, url: str, exception: BaseException):
+        future = self._in_flight.pop(make_cache_key(url), None)
+        if future is not None and not future.done():
+            future.set_exception(exception)
+            # mark the exception as retrieved in case nobody else waits for this key
+            future.exception()
+
+    def abandon(self, url: str):
+        """Drops the in-flight entry of a cancelled fetch: its waiters are not cancelled, they fetch the url again."""
+        future = self._in_flight.pop(make_cache_key(url), None)
+        if future is not None and not future.done():
+            future.cancel()
+
+    @staticmethod
+    async def wait(future: asyncio.Future) -> tp.Optional[dict]:
+        """The result of an in-flight fetch; None if it was abandoned and the url has to be fetched again."""
+        # unlike awaiting it, asyncio.wait neither raises the cancellation of the future nor cancels it
+        await asyncio.wait((future,))
+        return None if future.cancelled() else future.result()
+
+    async def get_or_fetch(self, url: str, fetch: tp.Callable[[], tp.Awaitable[dict]]) -> dict:
+        while True:
+            cached = self.get(url)
+            if cached is not None:
+                return cached
+            in_flight = self.get_in_flight(url)
+            if in_flight is None:
+                break
+            result = await self.wait(in_flight)
+            if result is not None:
+                return result
+
+        self.begin(url)
+        try:
+            result = await fetch()
+        except asyncio.CancelledError:
+            self.abandon(url)
+            raise
+        except BaseException as exception:
+            self.fail(url, exception)
+            raise
+        self.complete(url, result)
+        return result
@@ -1,4 +1,6 @@
+import asyncio
 import enum
+import functools
 import re
 
 from config import (
@@ -10,17 +12,28 @@ import typing as tp
 from exceptions import (
     EmptyCommandError,
     IncorrectCommandError,
-    CommandNotFoundError
+    CommandNotFoundError,
+    JobNotFoundError,
+    JobQueueFullError
 )
-from asyncrequest import AsyncRequest
+from asyncrequest import AsyncRequest, BatchedAsyncRequest
+from response_cache import ResponseCache
+from executors import AnalyticsExecutor, summarize_friends, summarize_friend_lists
+from jobs import JobManager
+from metrics import registry, COMMANDS, COMMAND_SECONDS, COMMANDS_IN_FLIGHT, STAGE_SECONDS
 from representation_functions import StaticResponse
 from vk_parser.pydantic_models import Profile, Photo, EntityType
+from vk_parser.mutual_friends import MutualFriendsEngine
+from vk_parser.query_plan import plan_query, SUMMARY_ANALYTICS
 
 
 class ErrorCode(enum.Enum):
     EMPTY_COMMAND = 0x1
     COMMAND_NOT_FOUND = 0x2
     INCORRECT_COMMAND = 0x3
+    JOB_NOT_FOUND = 0x4
+    JOB_QUEUE_FULL = 0x5
+    COMMAND_FAILED = 0x6
 
 
 class Commands(tp.NamedTuple):
@@ -28,12 +41,36 @@ class Commands(tp.NamedTuple):
     FRIENDS = "friends"
     EXIT = "exit"
     ISMUTUAL = "ismutual"
+    STATS = "stats"
+    SUBMIT = "submit"
+    STATUS = "status"
+    FETCH = "fetch"
+
+
+# shared by every connection, so repeated "friends"/"ismutual" queries are answered without going to VK
+command_cache = ResponseCache()
+# friend lists fetched by "friends" commands answer later "ismutual" commands without API calls
+mutual_friends = MutualFriendsEngine()
+# validation and analytics of friend lists run in worker pools, not on the event loop
+analytics_executor = AnalyticsExecutor()
+# "friends" replies are only summarized, so only the fields of the summary are requested
+summary_plan = plan_query(*SUMMARY_ANALYTICS)
+
+
+def stats_snapshot(_args=None) -> dict:
+    """Every metric, plus the state of every access token of the pool (without the tokens themselves)."""
+    result = registry.snapshot()
+    token_pool = AsyncRequest.default_scheduler.token_pool
+    if token_pool:
+        result["tokens"] = token_pool.snapshot(asyncio.get_running_loop().time())
+    return result
 
 
 message_map: tp.Dict[str, tp.Callable] = {
     Commands.HELP: StaticResponse.help,
-    Commands.FRIENDS: FriendsAPI.get,
-    Commands.ISMUTUAL: FriendsAPI.get_mutual
+    Commands.FRIENDS: summary_plan.friends_urls,
+    Commands.ISMUTUAL: FriendsAPI.get_mutual,
+    Commands.STATS: stats_snapshot
 }
 
 
@@ -47,14 +84,14 @@ def parse_command(message) -> CommandType:
                 IncorrectCommandError: If the message does not match the expected pattern.
                 CommandNotFoundError: If the message does not contain a valid command.
     """
-    print(message)
     if not message.strip():
         raise EmptyCommandError("[-] Command is empty!")
-    command = re.search(r"^(help|friends(\s+\d+){1,5}|ismutual(\s+\(\d+,\d+\)){1,5})$", message)
+    command = re.search(r"^(help|stats|friends(\s+\d+){1,5}|ismutual(\s+\(\d+,\d+\)){1,5}"
+                        r"|submit\s+(friends(\s+\d+)+|ismutual(\s+\(\d+,\d+\))+)"
+                        r"|status\s+\w+|fetch\s+\w+(\s+\d+)?)$", message)
     if not command:
         raise IncorrectCommandError(message)
     parts = command.group().split()
-    print(parts)
     command = parts.pop(0)
     return CommandType(command, parts)
 
@@ -67,30 +104,106 @@ async def execute_command(message: str) -> dict:
             """
     try:
         command: CommandType = parse_command(message)
-    except EmptyCommandError as traceback:
+    except (EmptyCommandError, CommandNotFoundError, IncorrectCommandError) as traceback:
+        COMMANDS.inc(command="invalid")
+        return command_error(traceback)
+
+    command_head = command.command
+    COMMANDS.inc(command=command_head)
+    with COMMANDS_IN_FLIGHT.track(), COMMAND_SECONDS.time(command=command_head):
+        return await run_command(command)
+
+
+def command_error(traceback: Exception) -> dict:
+    if isinstance(traceback, JobNotFoundError):
+        return form_error_json(error_code=ErrorCode.JOB_NOT_FOUND.value,
+                               error_message=f"[-] No such job: {str(traceback)}")
+    if isinstance(traceback, JobQueueFullError):
+        return form_error_json(error_code=ErrorCode.JOB_QUEUE_FULL.value,
+                               error_message=f"[-] Job queue is full: {str(traceback)}")
+    if isinstance(traceback, EmptyCommandError):
         return form_error_json(error_code=ErrorCode.EMPTY_COMMAND.value, error_message=str(traceback))
-    except CommandNotFoundError as traceback:
-        print("here")
+    if isinstance(traceback, CommandNotFoundError):
         return form_error_json(error_code=ErrorCode.COMMAND_NOT_FOUND.value,
                                error_message=f"[-] No such command: {str(traceback)}:" \
                f'\n To get a list of available commands, type "help"')
-    except IncorrectCommandError as traceback:
+    if isinstance(traceback, IncorrectCommandError):
         return form_error_json(error_code=ErrorCode.INCORRECT_COMMAND.value,
                                error_message=f"[-] Incorrect command: \n {str(traceback)} is not a valid expression. " \
                f'\n To get a list of available commands, type "help"')
+    # anything else failed while the command was running, e.g. an upstream timeout
+    return form_error_json(error_code=ErrorCode.COMMAND_FAILED.value,
+                           error_message=f"[-] Command failed: {traceback!r}")
+
 
+async def run_command(command: CommandType) -> tp.Union[str, dict, list]:
     command_head, command_args = command.command, command.args
-    if command_head == Commands.HELP:
-        executable = message_map[Commands.HELP]
+    if command_head in (Commands.HELP, Commands.STATS):
+        executable = message_map[command_head]
         result = executable(command_args)
+    elif command_head in (Commands.SUBMIT, Commands.STATUS, Commands.FETCH):
+        try:
+            result = run_job_command(command_head, command_args)
+        except (JobNotFoundError, JobQueueFullError) as traceback:
+            result = command_error(traceback)
+    elif command_head == Commands.ISMUTUAL:
+        mutual = await mutual_friends.get_mutual(command_args, cache=command_cache)
+        result = mutual_friends.to_response_list(mutual)
     else:
         coroutine = message_map[command_head]
-        request = AsyncRequest(coroutine(command_args))
+        request = BatchedAsyncRequest(coroutine(command_args), cache=command_cache)
         result = await request.run()
+        if command_head == Commands.FRIENDS:
+            mutual_friends.add_responses(command_args, result)
+            with STAGE_SECONDS.time(stage="analytics"):
+                result = await analytics_executor.run(summarize_friends, result)
 
     return result
 
 
+async def friends_job_chunk(user_ids: tp.List[str]) -> tp.List[dict]:
+    """One chunk of a "submit friends" job: the summary of the friend list of every user, one by one."""
+    result = await BatchedAsyncRequest(summary_plan.friends_urls(user_ids), cache=command_cache).run()
+    mutual_friends.add_responses(user_ids, result)
+    with STAGE_SECONDS.time(stage="analytics"):
+        summaries = await analytics_executor.run(summarize_friend_lists, result)
+    return [{"user_id": user_id, "summary": summary} if summary is not None else
+            {"user_id": user_id, "error": json_.get("error", json_) if isinstance(json_, dict) else json_}
+            for user_id, json_, summary in zip(user_ids, result, summaries)]
+
+
+async def ismutual_job_chunk(pairs: tp.List[str]) -> tp.List[dict]:
+    """One chunk of a "submit ismutual" job: friends.getMutual-like replies, one per pair."""
+    mutual = await mutual_friends.get_mutual(pairs, cache=command_cache)
+    return mutual_friends.to_response_list(mutual)
+
+
+# bulk "submit" commands of every connection run in the background, chunk by chunk
+job_manager = JobManager({Commands.FRIENDS: friends_job_chunk, Commands.ISMUTUAL: ismutual_job_chunk})
+
+
+def run_job_command(command_head: str, command_args: tp.List[str]) -> dict:
+    if command_head == Commands.SUBMIT:
+        kind, *items = command_args
+        # repeated ids would only be fetched twice; dropping them also keeps one result per id
+        return job_manager.submit(kind, list(dict.fromkeys(items))).status_json()
+    job = job_manager.get(command_args[0])
+    if command_head == Commands.STATUS:
+        return job.status_json()
+    return job.fetch_json(int(command_args[1]) if len(command_args) > 1 else 0)
+
+
+PLATFORM_NAMES: tp.Dict[int, str] = {
+    1: "VK Mobile version",
+    2: "Apple iPhone",
+    3: "Apple iPad",
+    4: "Android",
+    5: "Windows Phone",
+    6: "Windows 10",
+    7: "PC Web version"
+}
+
+
 class BirthDate(tp.NamedTuple):
     day: int
     month: int
@@ -116,43 +229,70 @@ class BaseDataTransformer:
         self._iterable = iterable
 
 
+BIRTH_DATE_PATTERN = re.compile(r"^(\d{1,2})[.-](\d{1,2})[.-](\d\d\d\d)$")
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_birth_date(bdate: str) -> BirthDate:
+    """"d.m.yyyy" or "d.m" into a BirthDate; memoized, as the same dates repeat a lot among profiles."""
+    result = BIRTH_DATE_PATTERN.search(bdate)
+    if result:
+        return BirthDate(*(int(value) for value in result.groups()))
+    return BirthDate(*(int(value) for value in re.split(r'[\.-]', bdate)))
+
+
+ProfileTransform = tp.Callable[[Profile], None]
+
+
 class ProfileTransformedList(BaseDataTransformer):
+    """Profiles with their raw VK fields rewritten in place by the registered transforms.
+
+    Transforms take a single profile; they run in one loop over the list together with the type check,
+    in the order they were registered. Every transform must be idempotent, since a profile may be
+    wrapped more than once. Subclasses inherit the transforms of their parent and may register their own
+    with the `register_transform` decorator."""
+
+    transforms: tp.List[ProfileTransform] = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.transforms = list(cls.transforms)
+
+    @classmethod
+    def register_transform(cls, transform: ProfileTransform) -> ProfileTransform:
+        cls.transforms.append(transform)
+        return transform
 
     @BaseDataTransformer.iterable.setter
     def iterable(self, iterable):
-        method_list = filter(lambda func:
-                             callable(getattr(self, func)) and not func.startswith("__"), dir(self))
-        for method in method_list:
-            getattr(self, method)(iterable)
-        super(ProfileTransformedList, ProfileTransformedList).iterable.__set__(self, iterable)
+        if not iterable:
+            raise ValueError('Empty iterable')
+        if not isinstance(iterable, list):
+            iterable = list(iterable)
+
+        transforms = self.transforms
+        with STAGE_SECONDS.time(stage="transform"):
+            for element in iterable:
+                if not isinstance(element, Profile):
+                    raise ValueError(f"Expected Iterable[Profile], got {type(element).__name__} instead")
+                for transform in transforms:
+                    transform(element)
+        self._iterable = iterable
 
     def __iter__(self):
         yield from self.iterable
 
-    @staticmethod
-    def _parse_birth_date(target_list: list[Profile]):
-        pattern = re.compile(r"^(\d{1,2})[.-](\d{1,2})[.-](\d\d\d\d)$")
-
-        for profile in filter(lambda user: user.bdate is not None, target_list):
-            result = pattern.search(profile.bdate)
-            if result:
-               profile.bdate = BirthDate(*(int(value) for value in result.groups()))
-            else:
-               profile.bdate = BirthDate(*(int(value) for value in re.split(r'[\.-]', profile.bdate)))
-
-    @staticmethod
-    def _parse_platform(target_list: list[Profile]):
-        platforms = {
-            1: "VK Mobile version",
-            2: "Apple iPhone",
-            3: "Apple iPad",
-            4: "Android",
-            5: "Windows Phone",
-            6: "Windows 10",
-            7: "PC Web version"
-        }
-        for profile in filter(lambda user: user.last_seen and user.last_seen.platform, target_list):
-            profile.last_seen.platform = platforms.get(profile.last_seen.platform, None)
 
+@ProfileTransformedList.register_transform
+def _transform_birth_date(profile: Profile):
+    bdate = profile.bdate
+    if isinstance(bdate, str):
+        # the field is already set, so pydantic's __setattr__ bookkeeping can be skipped
+        profile.__dict__["bdate"] = parse_birth_date(bdate)
 
 
+@ProfileTransformedList.register_transform
+def _transform_platform(profile: Profile):
+    last_seen = profile.last_seen
+    if last_seen and isinstance(last_seen.platform, int) and last_seen.platform:
+        last_seen.__dict__["platform"] = PLATFORM_NAMES.get(last_seen.platform, None)
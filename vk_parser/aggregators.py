@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+
+import heapq
+import typing as tp
+from collections import Counter, defaultdict
+from .pydantic_models import Profile
+from .vk_parser import FriendsParser
+
+
+class SpaceSavingCounter:
+    """Bounded-memory heavy hitters (Metwally et al. Space-Saving) with the merge rule
+    of Agarwal et al. "Mergeable summaries". At most `capacity` keys are tracked, every count
+    overestimates the true one by no more than its `errors` entry."""
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive.")
+        self.capacity = capacity
+        self.counts: tp.Dict[tp.Hashable, int] = {}
+        self.errors: tp.Dict[tp.Hashable, int] = {}
+        self._heap: tp.List[tp.Tuple[int, int, tp.Hashable]] = []
+        self._sequence = 0
+
+    def _push(self, key):
+        # heap entries are invalidated lazily: an entry is current only if its count is the key's count
+        self._sequence += 1
+        heapq.heappush(self._heap, (self.counts[key], self._sequence, key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, sequence, key) for count, sequence, key in self._heap
+                          if self.counts.get(key) == count]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self) -> tp.Tuple[tp.Hashable, int]:
+        while True:
+            count, _, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                return key, count
+
+    def add(self, key, count: int = 1) -> tp.Optional[tp.Hashable]:
+        """Counts the key; returns the key evicted to make room for it, if any."""
+        evicted = None
+        if key in self.counts:
+            self.counts[key] += count
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = count
+            self.errors[key] = 0
+        else:
+            evicted, min_count = self._pop_min()
+            del self.counts[evicted], self.errors[evicted]
+            self.counts[key] = min_count + count
+            self.errors[key] = min_count
+        self._push(key)
+        return evicted
+
+    def update(self, keys: tp.Iterable[tp.Hashable]):
+        for key in keys:
+            self.add(key)
+
+    def merge(self, other: "SpaceSavingCounter") -> "SpaceSavingCounter":
+        """Merges another summary into this one (in place) and keeps the `capacity` largest counts."""
+        self_min = min(self.counts.values()) if len(self.counts) >= self.capacity else 0
+        other_min = min(other.counts.values()) if len(other.counts) >= other.capacity else 0
+        counts, errors = {}, {}
+        for key in self.counts.keys() | other.counts.keys():
+            counts[key] = self.counts.get(key, self_min) + other.counts.get(key, other_min)
+            errors[key] = self.errors.get(key, self_min) + other.errors.get(key, other_min)
+
+        kept = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = {key: counts[key] for key in kept}
+        self.errors = {key: errors[key] for key in kept}
+        self._heap, self._sequence = [], 0
+        for key in self.counts:
+            self._push(key)
+        return self
+
+    def most_common(self, n: tp.Optional[int] = None) -> tp.List[tp.Tuple[tp.Hashable, int]]:
+        if n is None:
+            return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=lambda item: item[1])
+
+    def __getstate__(self):
+        return {"capacity": self.capacity, "counts": self.counts, "errors": self.errors}
+
+    def __setstate__(self, state):
+        self.__init__(state["capacity"])
+        self.counts, self.errors = state["counts"], state["errors"]
+        for key in self.counts:
+            self._push(key)
+
+    def __len__(self):
+        return len(self.counts)
+
+
+class TopKAggregator:
+    """Incremental counterpart of FriendsParser.get_most_frequent_university/get_most_frequent_city.
+    Profiles can be added as they stream in, and partial aggregators built on other responses
+    or in worker processes (they are picklable) can be merged together.
+    Without `capacity` the counts are exact; with it, at most `capacity` universities and cities are
+    tracked with Space-Saving and the counts of rare ones are approximate."""
+
+    def __init__(self, *, capacity: tp.Optional[int] = None):
+        self.capacity = capacity
+        self.universities = Counter() if capacity is None else SpaceSavingCounter(capacity)
+        self.cities = Counter() if capacity is None else SpaceSavingCounter(capacity)
+        self.university_names: tp.Dict[int, tp.Set[str]] = defaultdict(set)
+        self.profile_count = 0
+
+    @property
+    def exact(self) -> bool:
+        return self.capacity is None
+
+    def add(self, profile: Profile):
+        self.profile_count += 1
+        for university_id, names in FriendsParser.get_profile_universities(profile).items():
+            if self.exact:
+                self.universities[university_id] += 1
+            else:
+                evicted = self.universities.add(university_id)
+                if evicted is not None:
+                    del self.university_names[evicted]
+            self.university_names[university_id].update(names)
+
+        if isinstance(profile, Profile) and profile.city:
+            if self.exact:
+                self.cities[profile.city.title] += 1
+            else:
+                self.cities.add(profile.city.title)
+
+    def update(self, profile_list: tp.Iterable[Profile]) -> "TopKAggregator":
+        for profile in profile_list:
+            self.add(profile)
+        return self
+
+    def merge(self, other: "TopKAggregator") -> "TopKAggregator":
+        if self.exact != other.exact:
+            raise ValueError("Cannot merge exact and bounded aggregators.")
+        if self.exact:
+            self.universities.update(other.universities)
+            self.cities.update(other.cities)
+        else:
+            self.universities.merge(other.universities)
+            self.cities.merge(other.cities)
+        for university_id, names in other.university_names.items():
+            self.university_names[university_id].update(names)
+        if not self.exact:
+            for university_id in self.university_names.keys() - self.universities.counts.keys():
+                del self.university_names[university_id]
+        self.profile_count += other.profile_count
+        return self
+
+    def get_most_frequent_university(self, *, top_count=1) -> tp.Union[tuple, tuple[tuple[set, int]]]:
+        if not len(self.universities):
+            return ()
+        return tuple((self.university_names[university_id], count)
+                     for university_id, count in self.universities.most_common(max(top_count, 1)))
+
+    def get_most_frequent_city(self) -> tp.Optional[str]:
+        if not len(self.cities):
+            return None
+        city, _ = self.cities.most_common(1)[0]
+        return city
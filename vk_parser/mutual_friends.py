@@ -0,0 +1,146 @@
+# -*- coding: utf8 -*-
+
+import ast
+import time
+import typing as tp
+from collections import OrderedDict, defaultdict
+import numpy as np
+from asyncrequest import BatchedAsyncRequest
+from config import CacheSettings, FriendsAPI, DefaultRequestSettings
+from .pydantic_models import Profile
+
+PairType = tp.Tuple[int, int]
+
+
+class MutualFriendsEngine:
+    """Answers mutual-friends queries locally from known friend lists.
+    Friend lists are kept as sorted unique int64 arrays, so a pair is a single `intersect1d`.
+    At most `max_lists` of them are kept (least recently used ones are dropped first), each for `ttl` seconds.
+    Pairs with an unknown friend list fall back to friends.getMutual with up to 100 targets per request."""
+
+    def __init__(self, *, max_lists: int = CacheSettings.MAX_FRIEND_LISTS, ttl: float = CacheSettings.TTL):
+        self.max_lists = max_lists
+        self.ttl = ttl
+        self._friends: tp.OrderedDict[int, tp.Tuple[float, np.ndarray]] = OrderedDict()
+
+    def add_friend_list(self, user_id: int, friend_ids: tp.Iterable[int]):
+        user_id = int(user_id)
+        self._friends[user_id] = (time.time() + self.ttl, np.unique(np.fromiter(friend_ids, dtype=np.int64)))
+        self._friends.move_to_end(user_id)
+        while len(self._friends) > self.max_lists:
+            self._friends.popitem(last=False)
+
+    def add_profiles(self, user_id: int, profile_list: tp.Iterable[Profile]):
+        self.add_friend_list(user_id, (profile.id for profile in profile_list))
+
+    def add_responses(self, user_ids: tp.Iterable[int], response_list: tp.Iterable[dict]):
+        """Stores friends.get replies (raw JSON, in the order of `user_ids`).
+        Lists that are only a page of the whole friend list are skipped: they would give wrong answers."""
+        for user_id, json_ in zip(user_ids, response_list):
+            body = json_.get("response") if isinstance(json_, dict) else None
+            if not isinstance(body, dict) or "items" not in body:
+                continue
+            items = body["items"]
+            if body.get("count", len(items)) != len(items):
+                continue
+            self.add_friend_list(user_id, (item["id"] if isinstance(item, dict) else item for item in items))
+
+    def forget(self, user_id: int):
+        self._friends.pop(int(user_id), None)
+
+    def __contains__(self, user_id: int):
+        return self.get_friends(user_id) is not None
+
+    def __len__(self):
+        return len(self._friends)
+
+    def get_friends(self, user_id: int) -> tp.Optional[np.ndarray]:
+        user_id = int(user_id)
+        entry = self._friends.get(user_id)
+        if entry is None:
+            return None
+        expires_at, friend_ids = entry
+        if expires_at < time.time():
+            del self._friends[user_id]
+            return None
+        self._friends.move_to_end(user_id)
+        return friend_ids
+
+    def mutual(self, source: int, target: int) -> np.ndarray:
+        source_friends, target_friends = self.get_friends(source), self.get_friends(target)
+        if source_friends is None or target_friends is None:
+            raise KeyError(source if source_friends is None else target)
+        return np.intersect1d(source_friends, target_friends, assume_unique=True)
+
+    def mutual_count(self, source: int, target: int) -> int:
+        return len(self.mutual(source, target))
+
+    def all_pairs_counts(self, user_ids: tp.Optional[tp.Iterable[int]] = None) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """Returns (ids, counts) where counts[i, j] is the number of mutual friends of ids[i] and ids[j]
+        (the diagonal holds the size of each friend list). Every pair is one `intersect1d` of the lists
+        cut down to the friends that appear in at least two of them, so memory stays linear in the lists."""
+        friend_lists = {}
+        for user_id in (list(self._friends) if user_ids is None else user_ids):
+            friend_ids = self.get_friends(user_id)
+            if friend_ids is not None:
+                friend_lists[int(user_id)] = friend_ids
+        ids = np.fromiter(friend_lists, dtype=np.int64, count=len(friend_lists))
+        counts = np.zeros((len(ids), len(ids)), dtype=np.int64)
+        if not len(ids):
+            return ids, counts
+
+        all_friends, friend_counts = np.unique(np.concatenate(list(friend_lists.values())), return_counts=True)
+        shared = all_friends[friend_counts > 1]
+        shared_lists = [friend_ids[np.isin(friend_ids, shared, assume_unique=True)]
+                        for friend_ids in friend_lists.values()]
+        for i, source_friends in enumerate(shared_lists):
+            for j in range(i + 1, len(shared_lists)):
+                counts[i, j] = counts[j, i] = len(np.intersect1d(source_friends, shared_lists[j], assume_unique=True))
+        np.fill_diagonal(counts, [len(friend_ids) for friend_ids in friend_lists.values()])
+        return ids, counts
+
+    @staticmethod
+    def parse_pairs(target_list: tp.Iterable[tp.Union[str, PairType]]) -> tp.List[PairType]:
+        pairs = []
+        for pair in target_list:
+            if isinstance(pair, str):
+                pair = ast.literal_eval(pair)
+            source, target = pair
+            pairs.append((int(source), int(target)))
+        return pairs
+
+    async def get_mutual(self, target_list: tp.Iterable[tp.Union[str, PairType]], *,
+                         batch_size=DefaultRequestSettings.MUTUAL_TARGETS_LIMIT,
+                         **request_options) -> tp.Dict[PairType, tp.Optional[tp.List[int]]]:
+        """Mutual friends for every (source, target) pair; None if neither the engine nor VK could answer."""
+        result: tp.Dict[PairType, tp.Optional[tp.List[int]]] = {}
+        missing: tp.Dict[int, tp.List[int]] = defaultdict(list)
+        for source, target in self.parse_pairs(target_list):
+            if source in self and target in self:
+                result[source, target] = self.mutual(source, target).tolist()
+            else:
+                result[source, target] = None
+                if target not in missing[source]:
+                    missing[source].append(target)
+
+        url_list = [url for source, targets in missing.items()
+                    for url in FriendsAPI.get_mutual_targets(source, targets, batch_size=batch_size)]
+        sources = [source for source, targets in missing.items()
+                   for _ in range(0, len(targets), min(batch_size, DefaultRequestSettings.MUTUAL_TARGETS_LIMIT))]
+        if not url_list:
+            return result
+
+        for source, json_ in zip(sources, await BatchedAsyncRequest(url_list, **request_options).run()):
+            body = json_.get("response") if isinstance(json_, dict) else None
+            for item in body if isinstance(body, list) else ():
+                if isinstance(item, dict) and (source, item.get("id")) in result:
+                    result[source, item["id"]] = item.get("common_friends", [])
+        return result
+
+    @staticmethod
+    def to_response_list(result: tp.Dict[PairType, tp.Optional[tp.List[int]]]) -> tp.List[dict]:
+        """Formats the result as friends.getMutual replies, one per pair."""
+        return [{"response": [{"id": target, "common_friends": common_friends, "common_count": len(common_friends)}]}
+                if common_friends is not None else
+                {"error": {"error_code": 0, "error_msg": f"Could not get mutual friends of {source} and {target}"}}
+                for (source, target), common_friends in result.items()]
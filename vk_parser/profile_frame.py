@@ -0,0 +1,194 @@
+# -*- coding: utf8 -*-
+
+import typing as tp
+import numpy as np
+from service_functions import PLATFORM_NAMES
+from .pydantic_models import Profile
+from .vk_parser import FriendsParser, GroupingField, OccupationType
+
+MISSING = -1
+
+
+class OccupationCode(tp.NamedTuple):
+    NONE = 0
+    WORK = 1
+    UNIVERSITY = 2
+    OTHER = 3
+
+
+def _encode_strings(values: tp.List[tp.Optional[str]]) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """Dictionary-encodes strings: returns (codes, table), `table` is sorted,
+    so comparing codes is the same as comparing strings. Missing values get code -1."""
+    present = [value for value in values if value is not None]
+    table = np.array(sorted(set(present)), dtype=object)
+    index = {value: code for code, value in enumerate(table)}
+    codes = np.fromiter((index[value] if value is not None else MISSING for value in values),
+                        dtype=np.int32, count=len(values))
+    return codes, table
+
+
+class ProfileFrame:
+    """Columnar copy of a ProfileTransformedList: one fixed-width NumPy array per field
+    and dictionary-encoded string tables. Groupings and top-N counts are computed with
+    vectorized operations and return the same shapes as the FriendsParser methods."""
+
+    def __init__(self, columns: tp.Dict[str, np.ndarray], tables: tp.Dict[str, np.ndarray],
+                 profiles: tp.Optional[tp.Sequence[Profile]] = None):
+        self.columns = columns
+        self.tables = tables
+        self.profiles = profiles
+
+    @classmethod
+    def from_profiles(cls, profile_list: tp.Iterable[Profile], *, keep_profiles=True) -> "ProfileFrame":
+        """Builds the frame from transformed profiles (bdate is a BirthDate, platform is a name).
+        With `keep_profiles` the frame keeps references to the models, so that `group_by` yields profiles
+        instead of their ids."""
+        platform_codes = {name: code for code, name in PLATFORM_NAMES.items()}
+        profiles = list(profile_list)
+        ids, sexes, city_ids, city_titles, platforms, birth_years, birth_months = [], [], [], [], [], [], []
+        occupation_ids, occupation_types, occupation_names = [], [], []
+        university_offsets, university_ids = [0], []
+        university_codes: tp.Dict[int, int] = {}
+        university_names: tp.List[tp.Set[str]] = []
+
+        for profile in profiles:
+            ids.append(profile.id)
+            sexes.append(profile.sex or 0)
+            city_ids.append(profile.city.id if profile.city else MISSING)
+            city_titles.append(profile.city.title if profile.city else None)
+            platform = profile.last_seen.platform if profile.last_seen else None
+            platforms.append(platform_codes.get(platform, platform) if platform else 0)
+
+            bdate = profile.bdate if profile.bdate and not isinstance(profile.bdate, str) else None
+            birth_years.append(bdate.year if bdate and bdate.year is not None else 0)
+            birth_months.append(bdate.month if bdate else 0)
+
+            occupation = profile.occupation
+            occupation_ids.append(occupation.id if occupation and occupation.id is not None else MISSING)
+            occupation_names.append(occupation.name if occupation else None)
+            if not occupation:
+                occupation_types.append(OccupationCode.NONE)
+            elif occupation.type == OccupationType.WORK:
+                occupation_types.append(OccupationCode.WORK)
+            elif occupation.type == OccupationType.UNIVERSITY:
+                occupation_types.append(OccupationCode.UNIVERSITY)
+            else:
+                occupation_types.append(OccupationCode.OTHER)
+
+            for university_id, names in FriendsParser.get_profile_universities(profile).items():
+                if university_id not in university_codes:
+                    university_codes[university_id] = len(university_names)
+                    university_names.append(set())
+                code = university_codes[university_id]
+                university_names[code].update(names)
+                university_ids.append(code)
+            university_offsets.append(len(university_ids))
+
+        city_title_codes, city_table = _encode_strings(city_titles)
+        occupation_name_codes, occupation_table = _encode_strings(occupation_names)
+        columns = {
+            "id": np.array(ids, dtype=np.int64),
+            "sex": np.array(sexes, dtype=np.int8),
+            "city_id": np.array(city_ids, dtype=np.int32),
+            "city_title": city_title_codes,
+            "platform": np.array(platforms, dtype=np.int8),
+            "birth_year": np.array(birth_years, dtype=np.int16),
+            "birth_month": np.array(birth_months, dtype=np.int8),
+            "occupation_id": np.array(occupation_ids, dtype=np.int64),
+            "occupation_type": np.array(occupation_types, dtype=np.int8),
+            "occupation_name": occupation_name_codes,
+            "university_offsets": np.array(university_offsets, dtype=np.int64),
+            "university_codes": np.array(university_ids, dtype=np.int32),
+        }
+        university_table = np.empty(len(university_codes), dtype=object)
+        university_table[:] = list(university_codes)
+        names_table = np.empty(len(university_names), dtype=object)
+        names_table[:] = university_names
+        tables = {
+            "city_title": city_table,
+            "occupation_name": occupation_table,
+            "university_id": university_table,
+            "university_names": names_table,
+        }
+        return cls(columns, tables, profiles if keep_profiles else None)
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def _group_keys(self, group_field: str) -> tp.Tuple[tp.Optional[np.ndarray], tp.Callable[[int], tp.Any]]:
+        """Returns per-row integer keys that sort in the same order as the FriendsParser keys
+        (-1 for rows that are filtered out) and a function that decodes a key."""
+        columns, tables = self.columns, self.tables
+        if group_field == GroupingField.CITY:
+            table = tables["city_title"]
+            return columns["city_title"], lambda code: table[code]
+        if group_field == GroupingField.BDATE:
+            years, months = columns["birth_year"].astype(np.int32), columns["birth_month"].astype(np.int32)
+            return np.where(years > 0, years * 13 + months, MISSING), lambda code: (code // 13, code % 13)
+        if group_field == GroupingField.PLATFORM:
+            names = np.array(sorted(PLATFORM_NAMES.values()), dtype=object)
+            rank = np.full(max(PLATFORM_NAMES) + 1, MISSING, dtype=np.int32)
+            for code, name in PLATFORM_NAMES.items():
+                rank[code] = int(np.searchsorted(names, name))
+            platforms = columns["platform"].astype(np.int32)
+            known = (platforms > 0) & (platforms < len(rank))
+            return np.where(known, rank[np.where(known, platforms, 0)], MISSING), lambda code: names[code]
+        if group_field == GroupingField.OCCUPATION:
+            table = tables["occupation_name"]
+            is_work = columns["occupation_type"] == OccupationCode.WORK
+            return np.where(is_work, columns["occupation_name"], MISSING), lambda code: table[code]
+        return None, lambda code: code
+
+    def group_indices(self, *, group_field: str) -> tp.Generator[tp.Tuple[tp.Any, np.ndarray], None, None]:
+        """Yields (key, row indices) in descending key order; rows keep their original order inside a group."""
+        keys, decode = self._group_keys(group_field)
+        if keys is None:
+            return
+        rows = np.flatnonzero(keys >= 0)
+        rows = rows[np.argsort(-keys[rows], kind="stable")]
+        sorted_keys = keys[rows]
+        for chunk in np.split(rows, np.flatnonzero(np.diff(sorted_keys)) + 1):
+            if len(chunk):
+                yield decode(int(keys[chunk[0]])), chunk
+
+    def group_by(self, *, group_field: str) -> tp.Generator[tp.Tuple[tp.Any, tp.Iterable], None, None]:
+        """Same as FriendsParser.group_by; groups contain profiles if the frame keeps them, ids otherwise."""
+        for key, rows in self.group_indices(group_field=group_field):
+            if self.profiles is not None:
+                yield key, (self.profiles[row] for row in rows)
+            else:
+                yield key, self.columns["id"][rows]
+
+    def group_counts(self, *, group_field: str) -> tp.List[tp.Tuple[tp.Any, int]]:
+        keys, decode = self._group_keys(group_field)
+        if keys is None:
+            return []
+        unique_keys, counts = np.unique(keys[keys >= 0], return_counts=True)
+        return [(decode(int(key)), int(count)) for key, count in zip(unique_keys[::-1], counts[::-1])]
+
+    @staticmethod
+    def _top_codes(counts: np.ndarray, first_seen: np.ndarray, top_count: int) -> np.ndarray:
+        # ties are resolved in favour of the value that appeared first, as Counter does
+        present = np.flatnonzero(counts)
+        order = np.lexsort((first_seen[present], -counts[present]))
+        return present[order[:top_count]]
+
+    def get_most_frequent_city(self) -> tp.Optional[str]:
+        codes = self.columns["city_title"]
+        codes = codes[codes >= 0]
+        if not len(codes):
+            return None
+        counts = np.bincount(codes, minlength=len(self.tables["city_title"]))
+        first_seen = np.full(len(counts), len(codes), dtype=np.int64)
+        unique_codes, first_index = np.unique(codes, return_index=True)
+        first_seen[unique_codes] = first_index
+        return self.tables["city_title"][self._top_codes(counts, first_seen, 1)[0]]
+
+    def get_most_frequent_university(self, *, top_count=1) -> tp.Union[tuple, tuple[tuple[set, int]]]:
+        codes = self.columns["university_codes"]
+        if not len(codes):
+            return ()
+        # university codes are assigned in order of appearance
+        counts = np.bincount(codes, minlength=len(self.tables["university_names"]))
+        top_codes = self._top_codes(counts, np.arange(len(counts)), max(top_count, 1))
+        return tuple((self.tables["university_names"][code], int(counts[code])) for code in top_codes)
@@ -0,0 +1,126 @@
+# -*- coding: utf8 -*-
+
+import sys
+import typing as tp
+import numpy as np
+import pydantic as pd
+from .pydantic_models import Profile
+from .vk_parser import FriendsParser
+
+# sub-objects shared by many profiles: equal ones are kept once
+INTERNED_FIELDS = ("city", "occupation")
+INTERNED_LIST_FIELDS = ("universities",)
+
+
+class ProfileStore:
+    """Identity map of the profiles of several friends.get replies (e.g. of several seed users).
+
+    A profile is validated and transformed only the first time its id is seen, later copies of it are
+    skipped before validation. Strings and equal City, Occupation and University objects are shared
+    between profiles. The friends of every seed are kept as a sorted unique int64 array of ids,
+    as in MutualFriendsEngine, so memory and parsing time grow with the number of people,
+    not with the number of friendships."""
+
+    def __init__(self, parser: tp.Type[FriendsParser] = FriendsParser, *, trusted: bool = False):
+        """`parser` validates new profiles, e.g. the parser of a query plan; with `trusted` they are
+        built without validation (see BaseParser.iter_items)."""
+        self.parser = parser
+        self.trusted = trusted
+        self._profiles: tp.Dict[int, Profile] = {}
+        self._friends: tp.Dict[int, np.ndarray] = {}
+        self._objects: tp.Dict[tp.Tuple, pd.BaseModel] = {}
+
+    def add_response(self, seed_id: int, json_: dict):
+        """Stores one friends.get reply of `seed_id`; error replies are reported by the parser and skipped."""
+        body = json_.get("response") if isinstance(json_, dict) else None
+        items = body.get("items") if isinstance(body, dict) else None
+        if not isinstance(items, list):
+            for _ in self.parser.iter_items(json_, trusted=self.trusted):
+                pass
+            return
+
+        friend_ids, new_items, pending = [], [], set()
+        for item in items:
+            profile_id = item.get("id") if isinstance(item, dict) else None
+            if not isinstance(profile_id, int):
+                # left to the parser, which warns about it
+                new_items.append(item)
+                continue
+            friend_ids.append(profile_id)
+            if profile_id not in self._profiles and profile_id not in pending:
+                pending.add(profile_id)
+                new_items.append(item)
+
+        for profile in self.parser.iter_items({"response": {"items": new_items}}, trusted=self.trusted):
+            self._profiles[profile.id] = self.intern_profile(profile)
+            if profile.id not in pending:
+                friend_ids.append(profile.id)
+        profiles = self._profiles
+        self._friends[int(seed_id)] = np.unique(np.fromiter(
+            (profile_id for profile_id in friend_ids if profile_id in profiles), dtype=np.int64))
+
+    def add_responses(self, seed_ids: tp.Iterable[int], response_list: tp.Iterable[dict]):
+        """Stores friends.get replies in the order of `seed_ids`."""
+        for seed_id, json_ in zip(seed_ids, response_list):
+            self.add_response(seed_id, json_)
+
+    def intern_object(self, model: tp.Optional[pd.BaseModel]) -> tp.Optional[pd.BaseModel]:
+        """The stored object equal to `model`, or `model` itself (with its strings interned) if it is new."""
+        if model is None:
+            return None
+        values = model.__dict__
+        for name, value in values.items():
+            if type(value) is str:
+                values[name] = sys.intern(value)
+        try:
+            return self._objects.setdefault((type(model), *values.values()), model)
+        except TypeError:
+            # an unhashable value, e.g. a list: not worth interning
+            return model
+
+    def intern_profile(self, profile: Profile) -> Profile:
+        values = profile.__dict__
+        for name, value in values.items():
+            if type(value) is str:
+                values[name] = sys.intern(value)
+        for name in INTERNED_FIELDS:
+            if name in values:
+                values[name] = self.intern_object(values[name])
+        for name in INTERNED_LIST_FIELDS:
+            if values.get(name):
+                values[name] = [self.intern_object(item) for item in values[name]]
+        return profile
+
+    def get(self, profile_id: int) -> tp.Optional[Profile]:
+        return self._profiles.get(int(profile_id))
+
+    def __contains__(self, profile_id: int):
+        return int(profile_id) in self._profiles
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def profiles(self) -> tp.List[Profile]:
+        """Every unique profile, in the order they were first seen."""
+        return list(self._profiles.values())
+
+    @property
+    def seeds(self) -> tp.List[int]:
+        return list(self._friends)
+
+    def friend_ids(self, seed_id: int) -> tp.Optional[np.ndarray]:
+        return self._friends.get(int(seed_id))
+
+    def friends(self, seed_id: int) -> tp.List[Profile]:
+        friend_ids = self._friends.get(int(seed_id))
+        if friend_ids is None:
+            return []
+        return [self._profiles[profile_id] for profile_id in friend_ids.tolist()]
+
+    @property
+    def edge_count(self) -> int:
+        return sum(len(friend_ids) for friend_ids in self._friends.values())
+
+    def stats(self) -> dict:
+        return {"profiles": len(self._profiles), "seeds": len(self._friends), "edges": self.edge_count,
+                "shared_objects": len(self._objects)}
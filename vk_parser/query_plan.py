@@ -0,0 +1,79 @@
+import functools
+import pydantic as pd
+import typing as tp
+from config import FriendsAPI
+from .pydantic_models import APIError, project_profile
+
+
+class Analytics(tp.NamedTuple):
+    # the grouping ones have the names of GroupingField, so a group field is also an analytic
+    CITY = "city"
+    UNIVERSITY = "university"
+    OCCUPATION = "occupation"
+    PLATFORM = "platform"
+    BDATE = "bdate"
+    SURNAME = "surname"
+
+
+# VK fields every analytic reads; the Profile fields are named after them
+ANALYTIC_FIELDS: tp.Dict[str, tp.Tuple[str, ...]] = {
+    Analytics.CITY: ("city",),
+    # a university occupation counts as a university too (see FriendsParser.get_profile_universities)
+    Analytics.UNIVERSITY: ("universities", "occupation"),
+    Analytics.OCCUPATION: ("occupation",),
+    Analytics.PLATFORM: ("last_seen",),
+    Analytics.BDATE: ("bdate",),
+    # last names come with every profile
+    Analytics.SURNAME: (),
+}
+
+# without any field friends.get returns bare ids instead of profiles, so at least one is always requested
+REQUIRED_FIELDS = ("sex",)
+
+# what the "friends" command reports: the city groups, the top universities and the most frequent city
+SUMMARY_ANALYTICS = (Analytics.CITY, Analytics.UNIVERSITY)
+
+
+class QueryPlan:
+    """The VK fields and the slim models a set of analytics needs.
+    Payload size and validation time then depend on the question, not on DefaultRequestSettings.ALL_FIELDS."""
+
+    def __init__(self, analytics: tp.Tuple[str, ...]):
+        unknown = [analytic for analytic in analytics if analytic not in ANALYTIC_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown analytics: {', '.join(unknown)}")
+        self.analytics = analytics
+        self.profile_fields = tuple(sorted({*REQUIRED_FIELDS,
+                                            *(field for analytic in analytics for field in ANALYTIC_FIELDS[analytic])}))
+        self.fields = ",".join(self.profile_fields)
+        self.item_model = project_profile(self.profile_fields)
+        self.container_model = pd.create_model(f"Friends[{self.fields}]", items=(tp.List[self.item_model], ...))
+        self.response_model = pd.create_model(f"Response[{self.fields}]",
+                                              response=(tp.Optional[self.container_model], None),
+                                              error=(tp.Optional[APIError], None))
+
+    @functools.cached_property
+    def parser(self):
+        """FriendsParser that requests and validates only the fields of the plan."""
+        # vk_parser imports service_functions, which builds its plans when it is imported
+        from .vk_parser import FriendsParser
+        return type(f"FriendsParser[{self.fields}]", (FriendsParser,),
+                    {"item_model": self.item_model, "container_model": self.container_model,
+                     "response_model": self.response_model, "request_fields": self.fields})
+
+    def friends_urls(self, id_list: tp.Iterable, **options) -> tp.Generator[str, None, None]:
+        return FriendsAPI.get(id_list, fields=self.fields, **options)
+
+    def __repr__(self):
+        return f"{type(self).__name__}(analytics={self.analytics}, fields={self.fields!r})"
+
+
+@functools.lru_cache(maxsize=None)
+def plan_query(*analytics: str) -> QueryPlan:
+    """The plan of a set of analytics; the same analytics in any order and with repeats share one plan."""
+    return _plan(tuple(sorted(set(analytics))))
+
+
+@functools.lru_cache(maxsize=None)
+def _plan(analytics: tp.Tuple[str, ...]) -> QueryPlan:
+    return QueryPlan(analytics)
@@ -0,0 +1,380 @@
+# -*- coding: utf8 -*-
+
+import json
+import os
+import typing as tp
+import numpy as np
+from .pydantic_models import Profile
+from .profile_frame import ProfileFrame, MISSING
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pc = pq = None
+
+
+class SnapshotFormat(tp.NamedTuple):
+    COLUMNAR = "columnar"
+    PARQUET = "parquet"
+
+
+SNAPSHOT_VERSION = 1
+META_FILE = "meta.json"
+STRINGS_FILE = "strings.bin"
+STRING_OFFSETS_FILE = "strings.offsets"
+# fixed-width columns, one value per profile; string columns hold codes of the string dictionary
+COLUMN_DTYPES: tp.Dict[str, str] = {
+    "id": "<i8",
+    "sex": "<i1",
+    "city_id": "<i4",
+    "city_title": "<i4",
+    "platform": "<i1",
+    "birth_year": "<i2",
+    "birth_month": "<i1",
+    "occupation_id": "<i8",
+    "occupation_type": "<i1",
+    "occupation_name": "<i4",
+    "university_count": "<i4",
+}
+STRING_COLUMNS = ("city_title", "occupation_name")
+# variable-length column: the ids of the universities of every profile, `university_count` of them per profile
+UNIVERSITY_IDS_COLUMN = ("university_ids", "<i8")
+
+
+def default_format() -> str:
+    return SnapshotFormat.PARQUET if pq is not None else SnapshotFormat.COLUMNAR
+
+
+def _university_ids(frame: ProfileFrame) -> np.ndarray:
+    """Flattened university ids of every profile of the frame, in profile order."""
+    id_table = np.array(frame.tables["university_id"].tolist(), dtype=np.int64)
+    return id_table[frame.columns["university_codes"]] if len(id_table) else np.empty(0, dtype=np.int64)
+
+
+def _university_names(frame: ProfileFrame) -> tp.Dict[int, tp.Set[str]]:
+    return dict(zip(frame.tables["university_id"].tolist(), frame.tables["university_names"].tolist()))
+
+
+def _sorted_codes(codes: np.ndarray, strings: tp.Sequence[str]) -> tp.Tuple[np.ndarray, np.ndarray]:
+    """Re-encodes dictionary codes so that the table is sorted, as ProfileFrame expects: returns (codes, table)."""
+    used = np.unique(codes[codes >= 0])
+    values = [strings[code] for code in used.tolist()]
+    order = sorted(range(len(values)), key=values.__getitem__)
+    rank = np.full(int(used.max()) + 1 if len(used) else 0, MISSING, dtype=np.int32)
+    rank[used[order]] = np.arange(len(order), dtype=np.int32)
+    table = np.empty(len(order), dtype=object)
+    table[:] = [values[index] for index in order]
+    if not len(rank):
+        return np.full(len(codes), MISSING, dtype=np.int32), table
+    return np.where(codes >= 0, rank[np.maximum(codes, 0)], MISSING).astype(np.int32), table
+
+
+def _university_columns(counts: np.ndarray, university_ids: np.ndarray,
+                        names: tp.Dict[int, tp.Set[str]]) -> tp.Tuple[tp.Dict[str, np.ndarray],
+                                                                       tp.Dict[str, np.ndarray]]:
+    """ProfileFrame university columns: codes are assigned in order of first appearance."""
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    unique_ids, first_index, inverse = np.unique(university_ids, return_index=True, return_inverse=True)
+    order = np.argsort(first_index, kind="stable")
+    code_of_unique = np.empty(len(unique_ids), dtype=np.int32)
+    code_of_unique[order] = np.arange(len(unique_ids), dtype=np.int32)
+    id_table = np.empty(len(unique_ids), dtype=object)
+    id_table[:] = unique_ids[order].tolist()
+    names_table = np.empty(len(unique_ids), dtype=object)
+    names_table[:] = [set(names.get(university_id, ())) for university_id in id_table]
+    return ({"university_offsets": offsets, "university_codes": code_of_unique[inverse.ravel()]},
+            {"university_id": id_table, "university_names": names_table})
+
+
+class ColumnarSnapshotWriter:
+    """Built-in snapshot format: a directory with one raw little-endian file per column, a string dictionary
+    shared by the string columns (UTF-8 bytes plus int64 offsets) and meta.json.
+
+    Batches are appended to the column files; meta.json is replaced after every batch and holds the number
+    of complete rows, so a snapshot can be reopened for appending and data of an interrupted write is cut off."""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta = read_meta(path) if os.path.exists(os.path.join(path, META_FILE)) else None
+        self.rows = meta["rows"] if meta else 0
+        self.university_rows = meta["university_rows"] if meta else 0
+        self.universities: tp.Dict[int, tp.Set[str]] = \
+            {int(university_id): set(names) for university_id, names in (meta or {}).get("universities", {}).items()}
+        self._files: tp.Dict[str, tp.BinaryIO] = {}
+        column_sizes = {name: self.rows for name in COLUMN_DTYPES}
+        column_sizes[UNIVERSITY_IDS_COLUMN[0]] = self.university_rows
+        dtypes = {**COLUMN_DTYPES, UNIVERSITY_IDS_COLUMN[0]: UNIVERSITY_IDS_COLUMN[1]}
+        for name, size in column_sizes.items():
+            self._files[name] = self._open_truncated(f"{name}.bin", size * np.dtype(dtypes[name]).itemsize)
+
+        string_count = meta["strings"] if meta else 0
+        self._files[STRING_OFFSETS_FILE] = self._open_truncated(STRING_OFFSETS_FILE, string_count * 8)
+        offsets = np.fromfile(os.path.join(path, STRING_OFFSETS_FILE), dtype="<i8")
+        strings_size = int(offsets[-1]) if len(offsets) else 0
+        self._files[STRINGS_FILE] = self._open_truncated(STRINGS_FILE, strings_size)
+        with open(os.path.join(path, STRINGS_FILE), "rb") as file:
+            data = file.read()
+        starts = np.concatenate(([0], offsets[:-1])).tolist()
+        self._string_codes: tp.Dict[str, int] = {data[start:end].decode(): code for code, (start, end)
+                                                 in enumerate(zip(starts, offsets.tolist()))}
+        self._strings_size = strings_size
+        self.flush()
+
+    def _open_truncated(self, name: str, size: int) -> tp.BinaryIO:
+        file = open(os.path.join(self.path, name), "ab")
+        file.truncate(size)
+        return file
+
+    def encode(self, values: tp.Sequence[tp.Optional[str]]) -> np.ndarray:
+        """Dictionary codes of the strings; new strings are appended to the dictionary."""
+        codes = np.empty(len(values), dtype=np.int32)
+        new_strings, new_offsets = [], []
+        for index, value in enumerate(values):
+            if value is None:
+                codes[index] = MISSING
+                continue
+            code = self._string_codes.get(value)
+            if code is None:
+                code = self._string_codes[value] = len(self._string_codes)
+                encoded = value.encode()
+                new_strings.append(encoded)
+                self._strings_size += len(encoded)
+                new_offsets.append(self._strings_size)
+            codes[index] = code
+        if new_strings:
+            self._files[STRINGS_FILE].write(b"".join(new_strings))
+            np.array(new_offsets, dtype="<i8").tofile(self._files[STRING_OFFSETS_FILE])
+        return codes
+
+    def write(self, profile_list: tp.Iterable[Profile]):
+        """Appends a batch of transformed profiles, e.g. a ProfileTransformedList."""
+        frame = ProfileFrame.from_profiles(profile_list, keep_profiles=False)
+        if not len(frame):
+            return
+        columns = dict(frame.columns)
+        for name in STRING_COLUMNS:
+            # only the strings of the batch table are looked up; a missing value (-1) picks the appended -1
+            global_codes = np.append(self.encode(frame.tables[name].tolist()), np.int32(MISSING))
+            columns[name] = global_codes[columns[name]]
+        columns["university_count"] = np.diff(columns["university_offsets"])
+        for name, dtype in COLUMN_DTYPES.items():
+            np.ascontiguousarray(columns[name], dtype=dtype).tofile(self._files[name])
+        university_ids = _university_ids(frame)
+        university_ids.astype(UNIVERSITY_IDS_COLUMN[1]).tofile(self._files[UNIVERSITY_IDS_COLUMN[0]])
+        for university_id, university_names in _university_names(frame).items():
+            self.universities.setdefault(university_id, set()).update(university_names)
+
+        self.rows += len(frame)
+        self.university_rows += len(university_ids)
+        self.flush()
+
+    async def write_stream(self, profile_lists: tp.AsyncIterable[tp.Iterable[Profile]]):
+        """Appends every batch of a stream, e.g. FriendsParser.stream_friends."""
+        async for profile_list in profile_lists:
+            self.write(profile_list)
+
+    def flush(self):
+        for file in self._files.values():
+            file.flush()
+        meta = {"format": SnapshotFormat.COLUMNAR, "version": SNAPSHOT_VERSION, "rows": self.rows,
+                "university_rows": self.university_rows, "strings": len(self._string_codes),
+                "columns": {**COLUMN_DTYPES, UNIVERSITY_IDS_COLUMN[0]: UNIVERSITY_IDS_COLUMN[1]},
+                "universities": {str(university_id): sorted(names) for university_id, names in self.universities.items()}}
+        temporary_path = os.path.join(self.path, f"{META_FILE}.tmp")
+        with open(temporary_path, "w", encoding="utf8") as file:
+            json.dump(meta, file, ensure_ascii=False)
+        os.replace(temporary_path, os.path.join(self.path, META_FILE))
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ParquetSnapshotWriter:
+    """Snapshot as a Parquet file, one row group per batch. String columns are dictionary-encoded,
+    universities are a list column with the names of every university next to it."""
+
+    def __init__(self, path: str):
+        if pq is None:
+            raise ImportError("pyarrow is required for Parquet snapshots.")
+        self.path = path
+        self.rows = 0
+        self._writer = None
+
+    @staticmethod
+    def schema():
+        return pa.schema([
+            *((name, pa.dictionary(pa.int32(), pa.string())) if name in STRING_COLUMNS else
+              (name, pa.from_numpy_dtype(np.dtype(dtype)))
+              for name, dtype in COLUMN_DTYPES.items() if name != "university_count"),
+            ("university_ids", pa.list_(pa.int64())),
+            ("university_names", pa.list_(pa.list_(pa.string()))),
+        ])
+
+    def write(self, profile_list: tp.Iterable[Profile]):
+        frame = ProfileFrame.from_profiles(profile_list, keep_profiles=False)
+        if not len(frame):
+            return
+        columns, tables = frame.columns, frame.tables
+        schema = self.schema()
+        offsets = pa.array(columns["university_offsets"].astype(np.int32))
+        university_ids = _university_ids(frame)
+        names = _university_names(frame)
+        arrays = []
+        for field in schema:
+            if field.name in STRING_COLUMNS:
+                codes = columns[field.name]
+                arrays.append(pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes < 0),
+                                                             pa.array(tables[field.name].tolist(), pa.string())))
+            elif field.name == "university_ids":
+                arrays.append(pa.ListArray.from_arrays(offsets, pa.array(university_ids, pa.int64())))
+            elif field.name == "university_names":
+                arrays.append(pa.ListArray.from_arrays(offsets, pa.array(
+                    [sorted(names[university_id]) for university_id in university_ids.tolist()],
+                    field.type.value_type)))
+            else:
+                arrays.append(pa.array(columns[field.name], type=field.type))
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, schema)
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        self.rows += len(frame)
+
+    async def write_stream(self, profile_lists: tp.AsyncIterable[tp.Iterable[Profile]]):
+        async for profile_list in profile_lists:
+            self.write(profile_list)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_writer(path: str, *, format: tp.Optional[str] = None) -> tp.Union[ColumnarSnapshotWriter,
+                                                                          ParquetSnapshotWriter]:
+    """Parquet if pyarrow is installed, the built-in columnar format otherwise.
+    Only the built-in format can be reopened for appending."""
+    format = format or default_format()
+    if format == SnapshotFormat.PARQUET:
+        return ParquetSnapshotWriter(path)
+    if format == SnapshotFormat.COLUMNAR:
+        return ColumnarSnapshotWriter(path)
+    raise ValueError(f"Unknown snapshot format: {format}")
+
+
+def read_meta(path: str) -> dict:
+    with open(os.path.join(path, META_FILE), encoding="utf8") as file:
+        meta = json.load(file)
+    if meta.get("format") != SnapshotFormat.COLUMNAR or meta.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_VERSION} columnar snapshot.")
+    return meta
+
+
+class MappedStrings(tp.Sequence[str]):
+    """String dictionary of a columnar snapshot, memory-mapped; strings are decoded on access."""
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, code: int) -> str:
+        start = int(self._offsets[code - 1]) if code > 0 else 0
+        return bytes(self._data[start:int(self._offsets[code])]).decode()
+
+
+def _map(path: str, dtype: str, count: int) -> np.ndarray:
+    if not count:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class ProfileSnapshot:
+    """Read side of both formats. Numeric columns of a columnar snapshot are memory-mapped, not read,
+    so only the columns an analysis touches are paged in.
+
+    `to_frame` gives a ProfileFrame without profiles, i.e. the FriendsParser analytics (group_by,
+    get_most_frequent_city, get_most_frequent_university...) over the snapshot."""
+
+    def __init__(self, columns: tp.Dict[str, np.ndarray], strings: tp.Sequence[str],
+                 universities: tp.Dict[int, tp.Set[str]]):
+        self.columns = columns
+        self.strings = strings
+        self.universities = universities
+
+    @classmethod
+    def open(cls, path: str) -> "ProfileSnapshot":
+        if os.path.isdir(path):
+            return cls.open_columnar(path)
+        return cls.open_parquet(path)
+
+    @classmethod
+    def open_columnar(cls, path: str) -> "ProfileSnapshot":
+        meta = read_meta(path)
+        dtypes = meta["columns"]
+        columns = {name: _map(os.path.join(path, f"{name}.bin"), dtype, meta["rows"])
+                   for name, dtype in dtypes.items() if name != UNIVERSITY_IDS_COLUMN[0]}
+        columns[UNIVERSITY_IDS_COLUMN[0]] = _map(os.path.join(path, f"{UNIVERSITY_IDS_COLUMN[0]}.bin"),
+                                                 dtypes[UNIVERSITY_IDS_COLUMN[0]], meta["university_rows"])
+        offsets = _map(os.path.join(path, STRING_OFFSETS_FILE), "<i8", meta["strings"])
+        data = _map(os.path.join(path, STRINGS_FILE), "u1", int(offsets[-1]) if len(offsets) else 0)
+        universities = {int(university_id): set(names) for university_id, names in meta["universities"].items()}
+        return cls(columns, MappedStrings(data, offsets), universities)
+
+    @classmethod
+    def open_parquet(cls, path: str) -> "ProfileSnapshot":
+        if pq is None:
+            raise ImportError("pyarrow is required for Parquet snapshots.")
+        table = pq.read_table(path, memory_map=True)
+        columns = {name: table.column(name).to_numpy() for name in COLUMN_DTYPES
+                   if name not in STRING_COLUMNS and name != "university_count"}
+        # every row group has its own dictionary; the string columns are re-encoded with a single one
+        strings: tp.List[str] = []
+        for name in STRING_COLUMNS:
+            encoded = pc.dictionary_encode(table.column(name).cast(pa.string()).combine_chunks())
+            columns[name] = (encoded.indices.fill_null(MISSING - len(strings)).to_numpy(zero_copy_only=False)
+                             .astype(np.int32) + len(strings))
+            strings.extend(encoded.dictionary.to_pylist())
+        university_ids = table.column("university_ids").combine_chunks()
+        columns["university_count"] = pc.list_value_length(university_ids).fill_null(0).to_numpy().astype(np.int32)
+        columns[UNIVERSITY_IDS_COLUMN[0]] = pc.list_flatten(university_ids).to_numpy()
+
+        universities: tp.Dict[int, tp.Set[str]] = {}
+        university_names = pc.list_flatten(table.column("university_names").combine_chunks()).to_pylist()
+        for university_id, names in zip(columns[UNIVERSITY_IDS_COLUMN[0]].tolist(), university_names):
+            universities.setdefault(university_id, set()).update(names or ())
+        return cls(columns, strings, universities)
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def to_frame(self) -> ProfileFrame:
+        columns = {name: self.columns[name] for name in COLUMN_DTYPES
+                   if name not in STRING_COLUMNS and name != "university_count"}
+        tables = {}
+        for name in STRING_COLUMNS:
+            columns[name], tables[name] = _sorted_codes(np.asarray(self.columns[name]), self.strings)
+        university_columns, university_tables = _university_columns(
+            np.asarray(self.columns["university_count"], dtype=np.int64),
+            np.asarray(self.columns[UNIVERSITY_IDS_COLUMN[0]]), self.universities)
+        columns.update(university_columns)
+        tables.update(university_tables)
+        return ProfileFrame(columns, tables)
@@ -0,0 +1,78 @@
+# -*- coding: utf8 -*-
+
+import re
+import typing as tp
+from .pydantic_models import Profile
+from .vk_parser import LAST_NAME_SUFFIXES, LAST_NAME_ROOT_PATTERN
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+class SurnameIndex:
+    """Maps surname roots (with the same suffix rules as FriendsParser.get_people_with_the_same_last_name)
+    to profile ids. Built once, updated incrementally, answers every query with a dict lookup.
+
+    A profile matches a root if any word of its last name is the root followed by one of the suffixes,
+    so every word is indexed under each root it can be split into."""
+
+    def __init__(self, profile_list: tp.Iterable[Profile] = ()):
+        self._profiles: tp.Dict[int, Profile] = {}
+        # dicts with None values keep the ids in insertion order
+        self._roots: tp.Dict[str, tp.Dict[int, None]] = {}
+        self._last_names: tp.Dict[str, tp.Dict[int, None]] = {}
+        self.update(profile_list)
+
+    @staticmethod
+    def get_roots(last_name: str) -> tp.Set[str]:
+        roots = set()
+        for word in WORD_PATTERN.findall(last_name):
+            for suffix in LAST_NAME_SUFFIXES:
+                if len(word) > len(suffix) and word.endswith(suffix):
+                    roots.add(word[:-len(suffix)])
+        return roots
+
+    @staticmethod
+    def get_target_root(target_last_name: str) -> tp.Optional[str]:
+        last_name_matched = LAST_NAME_ROOT_PATTERN.search(target_last_name.capitalize())
+        return last_name_matched.group(1) if last_name_matched else None
+
+    def add(self, profile: Profile):
+        if profile.id in self._profiles:
+            self.remove(profile.id)
+        self._profiles[profile.id] = profile
+        self._last_names.setdefault(profile.last_name, {})[profile.id] = None
+        for root in self.get_roots(profile.last_name):
+            self._roots.setdefault(root, {})[profile.id] = None
+
+    def update(self, profile_list: tp.Iterable[Profile]):
+        for profile in profile_list:
+            self.add(profile)
+
+    def remove(self, profile_id: int):
+        profile = self._profiles.pop(profile_id, None)
+        if profile is None:
+            return
+        for key, index in ((profile.last_name, self._last_names),
+                           *((root, self._roots) for root in self.get_roots(profile.last_name))):
+            ids = index.get(key, {})
+            ids.pop(profile_id, None)
+            if not ids:
+                index.pop(key, None)
+
+    def get_ids(self, target_last_name: str) -> tp.List[int]:
+        last_name_root = self.get_target_root(target_last_name)
+        if last_name_root is None:
+            return list(self._last_names.get(target_last_name.capitalize(), ()))
+        return list(self._roots.get(last_name_root, ()))
+
+    def get_people_with_the_same_last_name(self, target_last_name: str) -> tp.List[Profile]:
+        return [self._profiles[profile_id] for profile_id in self.get_ids(target_last_name)]
+
+    def get_many(self, target_last_names: tp.Iterable[str]) -> tp.Dict[str, tp.List[Profile]]:
+        return {last_name: self.get_people_with_the_same_last_name(last_name) for last_name in target_last_names}
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def __contains__(self, profile_id: int):
+        return profile_id in self._profiles
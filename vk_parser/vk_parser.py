@@ -1,7 +1,9 @@
 # -*- coding: utf8 -*-
 
 import abc
+import asyncio
 import re
+import time
 import typing as tp
 import warnings
 import heapq
@@ -10,8 +12,17 @@ from itertools import groupby
 from operator import attrgetter
 from exceptions import BadJSONError, ValidationError
 from service_functions import ProfileTransformedList
-from .pydantic_models import Response, Profile, Photo
-from datetime import datetime
+from asyncrequest import PaginatedRequest
+from config import FriendsAPI, PhotosAPI, DefaultRequestSettings, PhotoSettings
+from metrics import STAGE_SECONDS
+from .pydantic_models import Response, Profile, Photo, APIError, Friends, Photos, trusted_construct
+from datetime import date, datetime, timedelta, timezone, tzinfo
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+EPOCH = date(1970, 1, 1)
+LAST_NAME_SUFFIXES = ("ov", "ev", "in", "skiy", "sky", "iy", "ova", "eva", "ina", "skaya", "aya")
+LAST_NAME_ROOT_PATTERN = re.compile(rf"\b(\w+)(?:{'|'.join(LAST_NAME_SUFFIXES)})\b")
 
 
 class OccupationType(tp.NamedTuple):
@@ -20,9 +31,14 @@ class OccupationType(tp.NamedTuple):
 
 
 class BaseParser(abc.ABC):
-
-    def __init__(self, response_list: list[dict]):
-        print(response_list)
+    item_model: tp.Type[tp.Union[Profile, Photo]]
+    container_model: tp.Type[tp.Union[Friends, Photos]]
+    response_model: tp.Type[Response] = Response
+
+    def __init__(self, response_list: list[dict], *, trusted: bool = False):
+        """With `trusted` the responses are taken as known-good VK payloads and the models are built
+        without validation (see trusted_construct)."""
+        self.trusted = trusted
         self.response = response_list
         self.response_items = (ProfileTransformedList(iterable=response.response.items) for response in self.response
                                if response.response is not None and response.response.items is not None)
@@ -36,14 +52,78 @@ class BaseParser(abc.ABC):
         if not response_list:
             raise ValueError("Empty response.")
         self._response = []
-        for json_ in response_list:
-            if not isinstance(json_, dict):
-                raise BadJSONError(f"Expected type Iterable[dict], "
-                                   f"got Iterable[{type(json_).__name__}] instead,\nitem={json_}")
+        with STAGE_SECONDS.time(stage="validation"):
+            for json_ in response_list:
+                if not isinstance(json_, dict):
+                    raise BadJSONError(f"Expected type Iterable[dict], "
+                                       f"got Iterable[{type(json_).__name__}] instead,\nitem={json_}")
+                if self.trusted:
+                    self._response.append(self.construct_response(json_))
+                    continue
+                try:
+                    self._response.append(self.response_model(**json_))
+                except ValidationError as tb:
+                    warnings.warn(f"Validation error: {tb.json()}")
+
+    @classmethod
+    def construct_response(cls, json_: dict) -> Response:
+        """Trusted counterpart of response_model(**json_)."""
+        body, error = json_.get("response"), json_.get("error")
+        return cls.response_model.construct(
+            response=trusted_construct(cls.container_model, body) if isinstance(body, dict) else None,
+            error=trusted_construct(APIError, error) if isinstance(error, dict) else None)
+
+    @staticmethod
+    def transform_items(items: tp.List[tp.Union[Profile, Photo]]) -> tp.Iterable[tp.Union[Profile, Photo]]:
+        return items
+
+    @classmethod
+    def iter_items(cls, json_: dict, *, trusted: bool = False,
+                   consume: bool = False) -> tp.Generator[tp.Union[Profile, Photo], None, None]:
+        """Validates the items of one raw response one by one (or, with `trusted`, builds them
+        without validation). The response is left as it is; with `consume` every raw item is dropped
+        from it as soon as its model is built, for callers that own the response and keep only the models."""
+        if not isinstance(json_, dict):
+            raise BadJSONError(f"Expected type dict, got {type(json_).__name__} instead,\nitem={json_}")
+        if "error" in json_:
             try:
-                self._response.append(Response(**json_))
+                warnings.warn(f"API error: {APIError(**json_['error']).error_json}")
             except ValidationError as tb:
                 warnings.warn(f"Validation error: {tb.json()}")
+            return
+        body = json_.get("response")
+        items = body.get("items") if isinstance(body, dict) else None
+        if not items:
+            return
+        # items are yielded one by one, so the validation time of the response is summed up and recorded once
+        validation_seconds = 0.0
+        try:
+            for index, item in enumerate(items):
+                if consume:
+                    items[index] = None
+                started = time.perf_counter()
+                model = None
+                if trusted:
+                    model = trusted_construct(cls.item_model, item)
+                else:
+                    try:
+                        model = cls.item_model(**item)
+                    except (ValidationError, TypeError) as tb:
+                        warnings.warn(f"Validation error: {tb.json() if isinstance(tb, ValidationError) else tb}")
+                validation_seconds += time.perf_counter() - started
+                if model is not None:
+                    yield from cls.transform_items([model])
+        finally:
+            STAGE_SECONDS.observe(validation_seconds, stage="validation")
+
+    @classmethod
+    async def stream_items(cls, responses: tp.AsyncIterable[dict], *, trusted: bool = False,
+                           consume: bool = False) -> tp.AsyncGenerator[tp.Union[Profile, Photo], None]:
+        """Streaming counterpart of the `response` setter: validates raw responses item by item,
+        so that neither the whole batch nor a full validated Response is ever held in memory."""
+        async for json_ in responses:
+            for item in cls.iter_items(json_, trusted=trusted, consume=consume):
+                yield item
 
     @abc.abstractmethod
     def parse(self, *args, **kwargs):
@@ -63,6 +143,40 @@ class GroupingField(tp.NamedTuple):
 
 
 class FriendsParser(BaseParser):
+    item_model = Profile
+    container_model = Friends
+    # VK fields of friends.get; the parsers of query plans request only those their models have
+    request_fields = DefaultRequestSettings.ALL_FIELDS
+
+    @classmethod
+    async def stream_friends(cls, user_id: int, *, fields=None,
+                             page_size=DefaultRequestSettings.FRIENDS_PAGE_SIZE,
+                             pages_in_flight=DefaultRequestSettings.PAGES_IN_FLIGHT, trusted: bool = False,
+                             **request_options) -> tp.AsyncGenerator[ProfileTransformedList, None]:
+        """Yields the whole friend list of a user page by page, as soon as each page arrives.
+        Pages after the first one may come out of order.
+        For the fast ingestion mode pass `trusted=True` together with `decoder=decode_json`."""
+        fields = fields or cls.request_fields
+        request = PaginatedRequest(lambda offset: FriendsAPI.get_page(user_id, fields=fields, count=page_size,
+                                                                      offset=offset),
+                                   page_size=page_size, pages_in_flight=pages_in_flight, **request_options)
+        async for json_ in request.iter_pages():
+            with STAGE_SECONDS.time(stage="validation"):
+                if trusted:
+                    response = cls.construct_response(json_)
+                else:
+                    try:
+                        response = cls.response_model(**json_)
+                    except ValidationError as tb:
+                        warnings.warn(f"Validation error: {tb.json()}")
+                        continue
+            if response.error or response.response is None or not response.response.items:
+                continue
+            yield ProfileTransformedList(iterable=response.response.items)
+
+    @staticmethod
+    def transform_items(items: tp.List[Profile]) -> tp.Iterable[Profile]:
+        return ProfileTransformedList(iterable=items)
 
     def parse(self, *args, **kwargs):
         print(self.response)
@@ -74,61 +188,94 @@ class FriendsParser(BaseParser):
                     print(i)
                 print()
 
+    @classmethod
+    async def parse_stream(cls, responses: tp.AsyncIterable[dict], *,
+                           group_field=GroupingField.CITY) -> tp.List[tp.Tuple[tp.Any, tp.List[Profile]]]:
+        """Groups of the profiles of raw responses that are still arriving, validated item by item."""
+        return await cls.group_stream(cls.stream_items(responses), group_field=group_field)
+
+    @staticmethod
+    def _is_valid_occupation(profile: Profile) -> bool:
+        return bool(profile.occupation) and profile.occupation.type == OccupationType.WORK
+
+    @staticmethod
+    def _is_valid_platform(profile: Profile) -> bool:
+        return bool(profile.last_seen and profile.last_seen.platform)
+
     @staticmethod
     def _filter_valid_occupation(target_list: ProfileTransformedList):
-        for profile in filter(lambda user: user.occupation, target_list):
-            if profile.occupation.type == OccupationType.WORK:
-                yield profile
+        return filter(FriendsParser._is_valid_occupation, target_list)
 
     @staticmethod
     def _filter_valid_platforms(target_list: ProfileTransformedList):
-        return filter(lambda user: user.last_seen and user.last_seen.platform, target_list)
+        return filter(FriendsParser._is_valid_platform, target_list)
 
-    def group_by(self, target_list: ProfileTransformedList, *, group_field: str):
-        """group_map is a dict that contains pairs of filters
-        (to filter invalid or empty fields from Pydantic models) and key functions that are necessary for
-         sorting Pydantic models & grouping them by defined field"""
-
-        group_map: dict[str, tuple[tp.Generator, tp.Callable]]
-        group_map = {
-            GroupingField.CITY: (filter(lambda profile: profile.city, target_list),
+    @staticmethod
+    def grouping_rules() -> dict[str, tuple[tp.Callable[[Profile], bool], tp.Callable]]:
+        """Pairs of predicates (to filter invalid or empty fields from Pydantic models) and key functions
+        that are necessary for sorting Pydantic models & grouping them by defined field"""
+        return {
+            GroupingField.CITY: (lambda profile: bool(profile.city),
                                  lambda profile: profile.city.title),
-            GroupingField.BDATE: (filter(lambda profile: profile.bdate and profile.bdate.year is not None, target_list),
+            GroupingField.BDATE: (lambda profile: bool(profile.bdate) and profile.bdate.year is not None,
                                   lambda profile: (profile.bdate.year, profile.bdate.month)),
-            GroupingField.PLATFORM: (self._filter_valid_platforms(target_list),
+            GroupingField.PLATFORM: (FriendsParser._is_valid_platform,
                                      lambda profile: profile.last_seen.platform),
-            GroupingField.OCCUPATION: (self._filter_valid_occupation(target_list),
+            GroupingField.OCCUPATION: (FriendsParser._is_valid_occupation,
                                        lambda profile: profile.occupation.name)
         }
-        field_generators = group_map.get(group_field, (None, None))
-        if not all(field_generators):
-            return ()
-        filter_gen, key_func = field_generators
-        if not key_func:
-            return filter_gen
 
-        for count, generator in groupby(sorted(filter_gen, key=key_func, reverse=True), key=key_func):
+    def group_by(self, target_list: ProfileTransformedList, *, group_field: str):
+        predicate, key_func = self.grouping_rules().get(group_field, (None, None))
+        if not predicate:
+            return
+
+        with STAGE_SECONDS.time(stage="grouping"):
+            sorted_list = sorted(filter(predicate, target_list), key=key_func, reverse=True)
+        for count, generator in groupby(sorted_list, key=key_func):
             yield count, generator
 
+    @classmethod
+    async def group_stream(cls, profiles: tp.AsyncIterable[Profile], *,
+                           group_field: str) -> tp.List[tp.Tuple[tp.Any, tp.List[Profile]]]:
+        """Same groups as `group_by`, but built while profiles are arriving:
+        every profile goes straight to its bucket, no intermediate list is sorted."""
+        predicate, key_func = cls.grouping_rules().get(group_field, (None, None))
+        if not predicate:
+            return []
+
+        groups: dict[tp.Any, tp.List[Profile]] = defaultdict(list)
+        async for profile in profiles:
+            if predicate(profile):
+                groups[key_func(profile)].append(profile)
+        return sorted(groups.items(), key=lambda group: group[0], reverse=True)
+
+    @staticmethod
+    def get_profile_universities(profile: Profile) -> dict[int, set[str]]:
+        """Universities of a profile, including a university occupation; every university appears once."""
+        universities: dict[int, set[str]] = {}
+        for university in profile.universities or ():
+            # a university without a name still counts
+            names = universities.setdefault(university.id, set())
+            if university.name:
+                names.add(university.name.strip())
+
+        occupation = profile.occupation
+        if occupation and occupation.type == OccupationType.UNIVERSITY:
+            if occupation.id and occupation.id not in universities:
+                universities[occupation.id] = {occupation.name.strip()}
+        return universities
+
     @staticmethod
     def get_most_frequent_university(profile_list: tp.List[Profile], *, top_count=1) -> tp.Union[tuple, tuple[tuple[str, int]]]:
         universities_count: Counter = Counter()
         universities_map = defaultdict(set)
 
         for profile in profile_list:
-            print(profile.occupation)
-            unique_universities = set()
-            if profile.universities:
-                for university in profile.universities:
-                    universities_map[university.id].add(university.name.strip())
-                    unique_universities.add(university.id)
-
-            if profile.occupation and profile.occupation.type == OccupationType.UNIVERSITY:
-                if profile.occupation.id and profile.occupation.id not in unique_universities:
-                    universities_map[profile.occupation.id].add(profile.occupation.name.strip())
-                    unique_universities.add(profile.occupation.id)
-
-            universities_count += Counter(unique_universities)
+            unique_universities = FriendsParser.get_profile_universities(profile)
+            for university_id, names in unique_universities.items():
+                universities_map[university_id].update(names)
+            universities_count.update(unique_universities.keys())
 
         if not universities_count:
             return ()
@@ -144,14 +291,13 @@ class FriendsParser(BaseParser):
     @staticmethod
     def get_people_with_the_same_last_name(*, target_last_name: str, profile_list: tp.List[Profile]) -> tp.Iterable[Profile]:
         target_last_name = target_last_name.capitalize()
-        regexp = re.compile(r"\b(\w+)(?:ov|ev|in|skiy|sky|iy|ova|eva|ina|skaya|aya)\b")
-        last_name_matched = regexp.search(target_last_name)
+        last_name_matched = LAST_NAME_ROOT_PATTERN.search(target_last_name)
 
         if not last_name_matched:
             return filter(lambda profile: profile.last_name == target_last_name, profile_list)
 
         last_name_root = last_name_matched.group(1)
-        match_last_names = re.compile(rf'\b{last_name_root}(?:ov|ev|in|skiy|sky|iy|ova|eva|ina|skaya|aya)\b')
+        match_last_names = re.compile(rf"\b{last_name_root}(?:{'|'.join(LAST_NAME_SUFFIXES)})\b")
         return filter(lambda profile: match_last_names.search(profile.last_name), profile_list)
 
     @staticmethod
@@ -163,13 +309,99 @@ class FriendsParser(BaseParser):
         return max(cities_count, key=lambda x: cities_count[x])
 
 
+class GroupingIndex:
+    """Hash buckets for every grouping field, built in a single pass over the profiles.
+    Later queries reuse the buckets instead of filtering and sorting the whole list again;
+    combined keys (e.g. city x platform) are built from the buckets once and cached."""
+
+    def __init__(self, target_list: tp.Iterable[Profile] = ()):
+        self._rules = FriendsParser.grouping_rules()
+        self._buckets: dict[str, dict[tp.Any, tp.List[Profile]]] = {field: defaultdict(list) for field in self._rules}
+        self._groups: dict[tp.Tuple[str, ...], tp.List[tp.Tuple[tp.Any, tp.List[Profile]]]] = {}
+        self.update(target_list)
+
+    def add(self, profile: Profile):
+        for field, (predicate, key_func) in self._rules.items():
+            if predicate(profile):
+                self._buckets[field][key_func(profile)].append(profile)
+        self._groups.clear()
+
+    def update(self, target_list: tp.Iterable[Profile]):
+        for profile in target_list:
+            self.add(profile)
+
+    def get(self, key, *, group_field: str) -> tp.List[Profile]:
+        return self._buckets.get(group_field, {}).get(key, [])
+
+    def _combine(self, group_fields: tp.Tuple[str, ...]) -> dict[tp.Tuple, tp.List[Profile]]:
+        first_field, *other_fields = group_fields
+        other_rules = [self._rules[field] for field in other_fields]
+        combined: dict[tp.Tuple, tp.List[Profile]] = defaultdict(list)
+        for key, profiles in self._buckets[first_field].items():
+            for profile in profiles:
+                if all(predicate(profile) for predicate, _ in other_rules):
+                    combined[(key, *(key_func(profile) for _, key_func in other_rules))].append(profile)
+        return combined
+
+    def groups(self, *group_fields: str) -> tp.List[tp.Tuple[tp.Any, tp.List[Profile]]]:
+        """(key, profiles) pairs in descending key order, like FriendsParser.group_by.
+        With several fields the key is a tuple of their keys."""
+        if not group_fields or any(field not in self._rules for field in group_fields):
+            return []
+        if group_fields not in self._groups:
+            with STAGE_SECONDS.time(stage="grouping"):
+                buckets = self._buckets[group_fields[0]] if len(group_fields) == 1 else self._combine(group_fields)
+                self._groups[group_fields] = sorted(buckets.items(), key=lambda group: group[0], reverse=True)
+        return self._groups[group_fields]
+
+    def group_by(self, *, group_field: str) -> tp.Iterator[tp.Tuple[tp.Any, tp.Iterator[Profile]]]:
+        return ((key, iter(profiles)) for key, profiles in self.groups(group_field))
+
+    def __getstate__(self):
+        # grouping rules are lambdas, they are rebuilt after unpickling
+        return {"buckets": {field: dict(buckets) for field, buckets in self._buckets.items()}}
+
+    def __setstate__(self, state):
+        self.__init__()
+        for field, buckets in state["buckets"].items():
+            self._buckets[field].update(buckets)
+
+
+class DayIndex:
+    """Local day numbers (days since the epoch) of timestamps: (timestamp + UTC offset) // SECONDS_PER_DAY.
+    The offset of `tz` (the local time zone by default) is looked up once per UTC day, not for every timestamp;
+    only within a day that has a DST transition it is looked up for every timestamp."""
+
+    def __init__(self, tz: tp.Optional[tzinfo] = PhotoSettings.TIMEZONE):
+        self.tz = tz
+        # UTC day -> the offset through all of it, None if it changes during the day
+        self._offsets: tp.Dict[int, tp.Optional[int]] = {}
+
+    def utc_offset(self, timestamp: int) -> int:
+        return int(datetime.fromtimestamp(timestamp, timezone.utc).astimezone(self.tz).utcoffset().total_seconds())
+
+    def __call__(self, timestamp: int) -> int:
+        utc_day = timestamp // SECONDS_PER_DAY
+        if utc_day not in self._offsets:
+            day_start = utc_day * SECONDS_PER_DAY
+            offset = self.utc_offset(day_start)
+            self._offsets[utc_day] = offset if self.utc_offset(day_start + SECONDS_PER_DAY - 1) == offset else None
+        offset = self._offsets[utc_day]
+        if offset is None:
+            offset = self.utc_offset(timestamp)
+        return (timestamp + offset) // SECONDS_PER_DAY
+
+
 class PhotoParser(BaseParser):
+    item_model = Photo
+    container_model = Photos
+
     def parse(self, *args, **kwargs):
         for response in self.response:
             if not response.response:
                 continue
-            for date, tags in self.group_tags(response.response.items):
-                print(date, ":")
+            for day, tags in self.group_tags(response.response.items):
+                print(day, ":")
                 for tag in tags:
                     print(self.vk_link_maker(tag))
                 print()
@@ -182,10 +414,53 @@ class PhotoParser(BaseParser):
         pass
 
     @staticmethod
-    def group_tags(tags_list: list[Photo]):
-        tags_list.sort(key=attrgetter('date'))
-        return groupby(tags_list, key=lambda tag: datetime.fromtimestamp(tag.date).strftime("%d-%m-%Y"))
+    def format_day(day: int) -> str:
+        """Formats a day number of DayIndex."""
+        return (EPOCH + timedelta(days=day)).strftime(PhotoSettings.DAY_FORMAT)
+
+    @staticmethod
+    def group_tags(tags_list: tp.Iterable[Photo], *,
+                   tz: tp.Optional[tzinfo] = PhotoSettings.TIMEZONE) -> tp.Iterator[tp.Tuple[str, tp.Iterator[Photo]]]:
+        """Groups tags by day, oldest first; the list of the caller is left as it is."""
+        day_of = DayIndex(tz)
+        days = groupby(sorted(tags_list, key=attrgetter("date")), key=lambda tag: day_of(tag.date))
+        return ((PhotoParser.format_day(day), tags) for day, tags in days)
+
+    @staticmethod
+    def merge_tags(*tags_lists: tp.Iterable[Photo], reverse: bool = False) -> tp.Iterator[Photo]:
+        """Merges lists that are already sorted by date (newest first with `reverse`) without sorting them again."""
+        return heapq.merge(*tags_lists, key=attrgetter("date"), reverse=reverse)
+
+    @staticmethod
+    async def stream_photos(user_id: int, *, page_size=DefaultRequestSettings.PHOTOS_PAGE_SIZE,
+                            pages_in_flight=DefaultRequestSettings.PAGES_IN_FLIGHT, trusted: bool = False,
+                            **request_options) -> tp.AsyncGenerator[Photo, None]:
+        """Yields every photo a user is tagged in, page by page in the order of VK (newest tag first);
+        the pages are fetched concurrently, at most `pages_in_flight` of them at a time.
+        The tag order is only loosely related to `date`, so the photos are not sorted by it."""
+        request = PaginatedRequest(lambda offset: PhotosAPI.get_page(user_id, count=page_size, offset=offset),
+                                   page_size=page_size, pages_in_flight=pages_in_flight, **request_options)
+        async for json_ in request.iter_pages(ordered=True):
+            for photo in PhotoParser.iter_items(json_, trusted=trusted, consume=True):
+                yield photo
 
+    @staticmethod
+    async def stream_tag_days(user_ids: tp.Iterable[int], *, tz: tp.Optional[tzinfo] = PhotoSettings.TIMEZONE,
+                              **stream_options) -> tp.AsyncGenerator[tp.Tuple[str, tp.List[Photo]], None]:
+        """Tags of all the users grouped by day, newest day first.
+        The photo streams of the users are read concurrently and every photo goes to the bucket of its day
+        as its page arrives. Any later page may still add to any day, so the days are yielded once
+        every page is in."""
+        day_of = DayIndex(tz)
+        days: tp.Dict[int, tp.List[Photo]] = defaultdict(list)
+
+        async def collect(user_id: int):
+            async for photo in PhotoParser.stream_photos(user_id, **stream_options):
+                days[day_of(photo.date)].append(photo)
+
+        await asyncio.gather(*(collect(user_id) for user_id in user_ids))
+        for day in sorted(days, reverse=True):
+            yield PhotoParser.format_day(day), days[day]
 
 
 # https://vk.com/photo-129220469_456239106?tag=350850226